@@ -1,16 +1,16 @@
 from dataclasses import dataclass
 from datetime import datetime
 
+import numpy as np
+
 from sas.database.db import DB
 from sas.pido_interface.pidoInterface import PIDOInterface
 
-from sas.kadmos_interface.cpacs import PortableCpacs
+from sas.kadmos_interface.cpacs import PortableCpacs, CpacsExtractor, CpacsStreamReader
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from sas.core.surrogate_model import SurrogateModel
-from lxml import etree
-from lxml.etree import ElementTree
 
 
 class DesignCompetence:
@@ -30,6 +30,9 @@ class DesignCompetence:
         self.input_variables = []
         self.output_variables = []
 
+        self.stream_cpacs = False  # Read CPACS files with the streaming reader instead of parsing the complete tree
+        self._cpacs_extractors = None  # Input and output extractor, built on first use
+
     def register_to_db(self, database: DB):
         """Register this discipline to a database controller.
 
@@ -51,28 +54,69 @@ class DesignCompetence:
                                          comments=None,
                                          sur_model=self.is_surrogate)
 
-    def add_cpacs_sample(self, database: DB, cpacs_in: str, cpacs_out: str, run_id: str, sample_in_run: int):
-        # Extract input variables from cpacs
-        parser = etree.XMLParser(remove_blank_text=True)
-        root_input = ElementTree(file=cpacs_in, parser=parser).getroot()
-
-        input_data = dict()
-        # Make assumption that inputs are always floats
-        for input_variable in self.input_variables:
-            input_data[input_variable] = float(root_input.xpath(input_variable)[0].text)
-
-        root_output = ElementTree(file=cpacs_out, parser=parser).getroot()
-        output_data = dict()
-        # Make assumption that inputs are always floats
-        for output_variable in self.output_variables:
-            output_data[output_variable] = float(root_output.xpath(output_variable)[0].text)
+    def add_cpacs_sample(self, database: DB, cpacs_in: str, cpacs_out: str, run_id: str, sample_in_run: int,
+                         streaming: bool = None):
+        input_data, output_data = self.extract_cpacs_sample(cpacs_in=cpacs_in, cpacs_out=cpacs_out, streaming=streaming)
 
         database.add_sample_to_tool(tool_id=self.uuid,
                                     run_id=run_id,
-                                    input_data=input_data,
-                                    output_data=output_data,
+                                    input_data=self._to_sample_data(self.input_variables, input_data.values()),
+                                    output_data=self._to_sample_data(self.output_variables, output_data.values()),
                                     sample_in_run=sample_in_run)
 
+    def add_extracted_samples(self, database: DB, samples: list[tuple[int, list, list]], run_id: str):
+        """Add samples of which the values are already extracted from the CPACS files, e.g. by worker processes, to the
+        database in a single batch.
+
+        :param database: Database object
+        :param samples: list of (sample_in_run, input values, output values), with the values in order of the input and
+                        output variables
+        :param run_id: uuid of run for identification in databases
+        """
+        batch = [dict(input=self._to_sample_data(self.input_variables, input_values),
+                      output=self._to_sample_data(self.output_variables, output_values),
+                      sample_in_run=sample_in_run) for sample_in_run, input_values, output_values in samples]
+
+        database.add_samples_to_tool(tool_id=self.uuid,
+                                     run_id=run_id,
+                                     batch=batch)
+
+    @staticmethod
+    def _to_sample_data(variables: list[str], values) -> dict:
+        """Sample data {'varN': value} for the database, in which vector variables are stored as lists."""
+        return {variable: value.tolist() if isinstance(value, np.ndarray) else value
+                for variable, value in zip(variables, values)}
+
+    def extract_cpacs_sample(self, cpacs_in: str, cpacs_out: str, streaming: bool = None):
+        """Extract the values of the input and output variables from a set of input and output CPACS files.
+
+        :param streaming: read the CPACS files with the streaming reader, defaults to self.stream_cpacs
+        :return: input and output data in format {'varN': float}
+        :rtype: [dict, dict]
+        """
+        input_extractor, output_extractor = self.get_cpacs_extractors(streaming=streaming)
+
+        # Make assumption that inputs and outputs are always floats
+        return input_extractor.extract(cpacs_in), output_extractor.extract(cpacs_out)
+
+    def get_cpacs_extractors(self, streaming: bool = None):
+        """Get the extractors for the input and output variables. Rebuilt when the variables have changed.
+
+        :param streaming: get CpacsStreamReaders instead of CpacsExtractors, defaults to self.stream_cpacs
+        :rtype: [CpacsExtractor, CpacsExtractor]
+        """
+        if streaming is None:
+            streaming = getattr(self, 'stream_cpacs', False)
+        extractor_class = CpacsStreamReader if streaming else CpacsExtractor
+
+        extractors = getattr(self, '_cpacs_extractors', None)
+        if extractors is None or type(extractors[0]) is not extractor_class or \
+                extractors[0].xpaths != self.input_variables or extractors[1].xpaths != self.output_variables:
+            extractors = (extractor_class(self.input_variables), extractor_class(self.output_variables))
+            self._cpacs_extractors = extractors
+
+        return extractors
+
 
 class Discipline(DesignCompetence):
     """Each design competence gets a discipline class"""
@@ -122,46 +166,75 @@ class Discipline(DesignCompetence):
                                                         ignore_in_training=ignore_in_training))
 
     def get_non_constant_input_variables(self):
-        inputs, outputs = self.registered_db.get_all_samples(tool_id=self.uuid)
+        input_statistics, _ = self.get_statistics()
 
         non_constant_vars = []
-        for input_var, var_data in inputs.items():
-            if not min(var_data)-max(var_data) == 0:
+        for input_var, statistics in input_statistics.items():
+            if np.any(np.greater(statistics['max'], statistics['min'])):  # Any element of vector variables
                 non_constant_vars.append(input_var)
 
         return non_constant_vars
 
+    def get_statistics(self):
+        """Get the running statistics of the samples of every variable, maintained by the columnar store of the
+        registered database as samples are added. Missing values are ignored.
+
+        :return: input and output dictionaries {'varN': {'count': int, 'min': float, 'max': float, 'mean': float,
+                 'variance': float}}
+        :rtype: [dict, dict]
+        """
+        return self.registered_db.get_column_store(self.uuid).get_statistics()
+
+    def get_column_store(self):
+        """Get the columnar store of the samples of this discipline in the registered database. See
+        DB.get_column_store."""
+        return self.registered_db.get_column_store(tool_id=self.uuid)
+
     def get_batched_samples(self):
         data = self.registered_db.get_all_samples(tool_id=self.uuid, batched=True)
         return data
 
-    def get_all_samples(self):
+    def get_all_samples(self, as_array=False):
         """ Get all samples for the discipline in the registered database
 
+        :param as_array: Return numpy arrays from the columnar store of the database instead of lists
         :return: list of input and output samples, in format {'varN': [sample1, sample2, sampleN], ...}
         """
-        inputs, outputs = self.registered_db.get_all_samples(tool_id=self.uuid)
+        inputs, outputs = self.registered_db.get_all_samples(tool_id=self.uuid, as_array=as_array)
 
         return inputs, outputs
 
     def get_mean_of_samples(self):
-        inputs, outputs = self.get_all_samples()
+        input_statistics, output_statistics = self.get_statistics()
 
         input_means = {}
         output_means = {}
 
-        for input_var in inputs:
-            input_means[input_var] = sum(inputs[input_var]) / len(inputs[input_var])
+        for input_var, statistics in input_statistics.items():
+            input_means[input_var] = statistics['mean']
 
-        for output_var in outputs:
-            output_means[output_var] = sum(outputs[output_var]) / len(outputs[output_var])
+        for output_var, statistics in output_statistics.items():
+            output_means[output_var] = statistics['mean']
 
         return input_means, output_means
 
+    def get_samples_since(self, seq: int):
+        """Get the samples that are added to the registered database after sequence number seq. See
+        DB.get_samples_since.
+
+        :return: samples, current sequence number of the discipline, full
+        :rtype: [list[dict], int, bool]
+        """
+        return self.registered_db.get_samples_since(tool_id=self.uuid, seq=seq)
+
+    @property
+    def sample_seq(self):
+        """Version of the samples of this discipline in the registered database. Increases on every change."""
+        return self.registered_db.get_tool_seq(tool_id=self.uuid)
+
     @property
     def n_available_samples(self):
-        inputs, outputs = self.get_all_samples()
-        return len(next(iter(inputs.values())))
+        return self.registered_db.get_column_store(self.uuid).n_samples
 
 @dataclass
 class HiddenConstraint:
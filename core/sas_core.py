@@ -8,8 +8,10 @@ from sas.core.advise import Advisor
 from sas.pido_interface.pidoInterface import PIDOInterface
 from sas.pido_interface.rceInterface import RCEInterface
 from sas.kadmos_interface.kadmos_interface import KadmosInterface
-from sas.kadmos_interface.cpacs import PortableCpacs
+from sas.kadmos_interface.cpacs import PortableCpacs, CpacsStreamReader
 from sas.database.db import DB
+from sas.database.sqlite_db import SQLiteDB
+from sas.database.archive import FileArchive
 
 from datetime import datetime
 import datetime as dt
@@ -42,10 +44,11 @@ class SAS:
     def __init__(self, sas_workspace: str = None,
                  cmdows_opt_file: str = None,
                  initial_cpacs: str = None,
-                 runs_output_location: str = None):
+                 runs_output_location: str = None,
+                 database_backend: str = 'json'):
 
         self._init_sas_workspace(sas_workspace)
-        self.database = DB(self.sas_workspace)
+        self._init_database(database_backend)
         if cmdows_opt_file:
             self.init_kadmos(cmdows_opt_file=cmdows_opt_file)
         self.workflow_analysis = WorkflowAnalysis(disciplines=self.disciplines)
@@ -102,6 +105,23 @@ class SAS:
 
             self.sas_workspace = sas_workspace
 
+    def _init_database(self, database_backend: str = 'json'):
+        """Init the database that stores the tools, runs and samples of the SAS workspace.
+
+        :param database_backend: 'json' for the original JSON files, 'journal' for the JSON files with an append-only
+                                 journal, 'sqlite' for the indexed SQLite storage engine. An existing JSON workspace is
+                                 migrated when switching to 'sqlite'.
+        :type database_backend: str
+        """
+        if database_backend == 'json':
+            self.database = DB(self.sas_workspace)
+        elif database_backend == 'journal':
+            self.database = DB(self.sas_workspace, journal=True)
+        elif database_backend == 'sqlite':
+            self.database = SQLiteDB(self.sas_workspace)
+        else:
+            raise AssertionError("Please provide a valid database_backend: 'json', 'journal' or 'sqlite'")
+
     def _extract_disciplines(self):
         """From CMDOWS file extract all disciplines and assign their coupling variables"""
         self.disciplines = self.kadmos.get_disciplines()
@@ -161,15 +181,31 @@ class SAS:
         """
         return [tool.id for tool in self.disciplines]
 
-    def init_pido(self, pido_path: str = None, test_connection: bool = False, run_file: str = None):
+    def init_pido(self, pido_path: str = None, test_connection: bool = False, run_file: str = None,
+                  archive_run_files: bool = False, n_workers: int = 1):
+        """Init the interface to the PIDO platform.
+
+        :param archive_run_files: store the files of processed runs deduplicated and compressed in the archive of the
+                                  workspace (storage/archive), instead of moving the raw run folders to storage/data
+        :type archive_run_files: bool
+        :param n_workers: amount of worker processes that extract the samples of a run from its CPACS files. None uses
+                          all CPUs
+        :type n_workers: int
+        """
+        archive = FileArchive(self.database.archive_folder) if archive_run_files else None
+
         if pido_path:
             self.pido_interface = RCEInterface(pido_path=pido_path,
                                                test_connection=test_connection,
-                                               run_file=run_file)
+                                               run_file=run_file,
+                                               archive=archive,
+                                               n_workers=n_workers)
         else:
             self.pido_interface = RCEInterface(pido_path=r"\Dev\Thesis\rce\rce.exe",
                                                test_connection=test_connection,
-                                               run_file=run_file)
+                                               run_file=run_file,
+                                               archive=archive,
+                                               n_workers=n_workers)
 
         self.pido_interface.set_pido_output(self.sas_workspace)
 
@@ -193,7 +229,20 @@ class SAS:
                                             final_storage_base_folder=final_storage_base_folder,
                                             run_id=run_id)
 
-    def init_surrogate_model(self, disciplines: Union[str, list[str], tuple[str]]):
+    def init_surrogate_model(self, disciplines: Union[str, list[str], tuple[str]], thin_iterations: bool = False,
+                             iteration_tolerance: float = 1e-3):
+        """Initialize a surrogate model for one or more disciplines, or bring the data of an existing one up to date.
+        An existing surrogate model that was created with other thinning settings is created again.
+
+        :param disciplines: discipline id, or ids of the disciplines to combine. Include 'Converger' for a converged
+            loop
+        :param thin_iterations: merge the iterations of the converger that fall in the same grid cell into the last one,
+            which only removes samples. Only for a single discipline in a converged loop, e.g. ('Converger', 'D1')
+        :param iteration_tolerance: grid step as fraction of the input range. Near-identical iterations on either side
+            of a cell boundary are not merged
+        :return: key of the surrogate model in surrogate_models
+        :rtype: tuple
+        """
         if (isinstance(disciplines, list) or isinstance(disciplines, tuple)) and 'Converger' in disciplines:
             converged = True
         else:
@@ -206,18 +255,22 @@ class SAS:
 
         if isinstance(disciplines, str):
             key = tuple([disciplines])
+            self._remove_surrogate_model_with_other_settings(key, thin_iterations, iteration_tolerance)
 
             if key not in self.surrogate_models:
                 surrogate_model = SurrogateModel(disciplines=self.get_discipline(disciplines),
                                                  input_variables=inputs,
                                                  output_variables=outputs,
-                                                 all_inputs=all_inputs)
+                                                 all_inputs=all_inputs,
+                                                 thin_iterations=thin_iterations,
+                                                 iteration_tolerance=iteration_tolerance)
                 self.surrogate_models[key] = surrogate_model
                 surrogate_model.register_to_db(self.database)
-            else:
+            elif not self.surrogate_models[key].is_up_to_date:
                 self.surrogate_models[key].update_data()
         elif isinstance(disciplines, list) or isinstance(disciplines, tuple):
             key = tuple(disciplines)
+            self._remove_surrogate_model_with_other_settings(key, thin_iterations, iteration_tolerance)
             if key not in self.surrogate_models:
                 surrogate_model = SurrogateModel(
                     disciplines=[self.get_discipline(discipline) for discipline in disciplines if
@@ -225,18 +278,40 @@ class SAS:
                     input_variables=inputs,
                     output_variables=outputs,
                     converged=converged,
-                    all_inputs=all_inputs)
+                    all_inputs=all_inputs,
+                    thin_iterations=thin_iterations,
+                    iteration_tolerance=iteration_tolerance)
                 self.surrogate_models[key] = surrogate_model
                 surrogate_model.register_to_db(self.database)
-            else:
+            elif not self.surrogate_models[key].is_up_to_date:
                 self.surrogate_models[key].update_data()
         else:
             raise AssertionError('Please provide surrogate model candidates in correct format')
 
         return key
 
-    def build_surrogate_model(self, disciplines: Union[str, list[str], tuple[str]], **kwargs):
-        key = self.init_surrogate_model(disciplines)
+    def _remove_surrogate_model_with_other_settings(self, key: tuple, thin_iterations: bool,
+                                                    iteration_tolerance: float):
+        surrogate_model = self.surrogate_models.get(key)
+        if surrogate_model is not None and (surrogate_model.thin_iterations != thin_iterations or
+                                            surrogate_model.iteration_tolerance != iteration_tolerance):
+            print(f'Surrogate model {key} is created again with thin_iterations={thin_iterations} and '
+                  f'iteration_tolerance={iteration_tolerance}')
+            del self.surrogate_models[key]
+
+    def build_surrogate_model(self, disciplines: Union[str, list[str], tuple[str]], thin_iterations: bool = False,
+                              iteration_tolerance: float = 1e-3, **kwargs):
+        """Initialize a surrogate model for one or more disciplines, see init_surrogate_model, and train it.
+
+        :param disciplines: discipline id, or ids of the disciplines to combine
+        :param thin_iterations: see init_surrogate_model
+        :param iteration_tolerance: see init_surrogate_model
+        :param kwargs: options for SurrogateModel.build
+        :return: key of the surrogate model in surrogate_models
+        :rtype: tuple
+        """
+        key = self.init_surrogate_model(disciplines, thin_iterations=thin_iterations,
+                                        iteration_tolerance=iteration_tolerance)
         self.surrogate_models[key].build(**kwargs)
 
         return key
@@ -262,6 +337,9 @@ class SAS:
         surrogate_name = f"{datetime.strftime(datetime.now(), timestamp_format)}.pickle"
         file = os.path.join(file_folder, surrogate_name)
 
+        # Locations of the inputs and outputs are precomputed for the layout of the CPACS files of the workflow
+        self.surrogate_models[key].build_response_writer(template_cpacs=self.initial_cpacs)
+
         with open(file, 'w+b') as f:
             pickle.dump(self.surrogate_models[key], f)
 
@@ -381,12 +459,24 @@ class SAS:
 
         return advisor
 
-    def build_sampling_point_from_cpacs(self, cpacs: str):
+    def build_sampling_point_from_cpacs(self, cpacs: str, streaming: bool = False):
+        """Get the values of the design variables from a CPACS file.
+
+        :param cpacs: path of CPACS file
+        :param streaming: read only the design variables with the streaming reader, instead of loading the complete
+            file. Both give the same values, streaming avoids holding large CPACS files in memory
+        :return: {design variable: value}
+        :rtype: dict
+        """
+        xpaths = [design_variable.parameter_uid for design_variable in self.design_variables]
+        if streaming:
+            return CpacsStreamReader(xpaths).extract(cpacs)
+
         cpacs = PortableCpacs(cpacs_in=cpacs)
 
         sample_point = {}
-        for design_variable in self.design_variables:
-            sample_point[design_variable.parameter_uid] = cpacs.get_value(design_variable.parameter_uid)
+        for xpath in xpaths:
+            sample_point[xpath] = cpacs.get_value(xpath)
 
         return sample_point
 
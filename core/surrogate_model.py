@@ -13,7 +13,7 @@ import prettytable
 
 from sklearn.ensemble import RandomForestClassifier
 from sas.core.discipline import DesignCompetence, Discipline
-from sas.kadmos_interface.cpacs import PortableCpacs
+from sas.kadmos_interface.cpacs import PortableCpacs, CpacsResponseWriter
 from typing import Union
 
 
@@ -72,7 +72,9 @@ class SurrogateModel(DesignCompetence):
                  input_variables=None,
                  output_variables=None,
                  converged=False,
-                 all_inputs=None):
+                 all_inputs=None,
+                 thin_iterations=False,
+                 iteration_tolerance=1e-3):
 
         if isinstance(disciplines, Discipline):
             kadmos_uid = f"{disciplines.uid}_SM"
@@ -95,6 +97,11 @@ class SurrogateModel(DesignCompetence):
                                              version=version,
                                              status=status)
         self.converged = converged
+        self.thin_iterations = thin_iterations  # Merge near-identical iterations of the converger, see _converged_keys
+        self.iteration_tolerance = iteration_tolerance  # Grid step for thinning iterations, relative to input range
+        self._iteration_grid = None  # Minimum, step and maximum of the grid on which iterations are thinned
+        assert not thin_iterations or (converged and len(disciplines) == 1), \
+            "Iterations can only be thinned for a surrogate model of a single discipline in a converged loop"
         self.input_variables = None
         self.output_variables = None
         self.input_data = None
@@ -102,22 +109,32 @@ class SurrogateModel(DesignCompetence):
         self.n_total_samples = 0
         self.hidden_constraints = []
         self.validation_metric = 'RMSPE'
+        self.synced_seqs = {}  # Sequence number of the samples of each discipline at the last update of the data
+        self.sample_keys = []  # (run_id, sample_in_run) of every row of the data
+        self._merged_samples = set()  # (run_id, sample_in_run) of all samples that are merged into the data
+        self._pending_samples = None  # discipline uuid -> {(run_id, sample_in_run): sample} not available for all
+        self._converged_rows = {}  # Input row -> index of row, to replace samples with identical inputs
+        self._linear_fit_sums = None  # See _update_linear_fit_sums
 
         # SMT works with numpy. Following properties handle this:
         self.all_input_samples = None
         self.all_output_samples = None
         self.input_samples_indices = None
         self.output_samples_indices = None
+        self.input_vector_indices = {}  # Vector variable -> column indices of its elements
+        self.output_vector_indices = {}
 
         self.surrogate = None
         self.error = None
+        self.response_writer = None  # Writes the CPACS response when deployed, built by build_response_writer
 
         # Processing of hidden constraints
         self.valid_input_samples = None
         self.valid_output_samples = None
         self.n_valid_samples = None
-        self.invalid_samples = []
+        self.invalid_samples = np.zeros(0, dtype=int)  # Indices of the samples that violate hidden constraints
         self.hidden_constraint_output_indices = None
+        self.hidden_constraint_override = None  # See update_hidden_constraint_override
 
         if disciplines:
             self.add_disciplines(disciplines, input_variables, output_variables)
@@ -147,6 +164,8 @@ class SurrogateModel(DesignCompetence):
         else:
             raise AssertionError("Please provide valid mode: 'automatic', 'optimize_config', or 'fixed_type'")
 
+        self.update_hidden_constraint_override()
+
     def validate(self, sur_model: smt = None, method='k-fold', **kwargs):
         """ Validate a surrogate model using a range of techniques
 
@@ -188,6 +207,7 @@ class SurrogateModel(DesignCompetence):
         self.output_variables = output_variables
 
         self.disciplines = disciplines
+        self._pending_samples = None  # Rebuild all data for the new disciplines
 
         self.update_data()
 
@@ -203,91 +223,289 @@ class SurrogateModel(DesignCompetence):
         """Retreive all the data from the connected disciplines.
 
         Consistency between samples for multiple disciplines is ensured by tracking the run_id and sample number in run.
+        When the data is built already, only the samples that are added since the last update are merged (see
+        _merge_new_samples). Otherwise, or when samples are deleted, all data is rebuilt.
         """
+        if self._merge_new_samples():
+            return
+
+        self.synced_seqs = {discipline.uuid: discipline.sample_seq for discipline in self.disciplines}
         self._find_in_and_output_providers()
-        data = {}
-        discipline = self.disciplines[0]
-        initial_data = discipline.get_batched_samples()
+        stores = [discipline.get_column_store() for discipline in self.disciplines]
+        matched_rows, sample_keys = self._join_samples(stores)
+        columns = {discipline: store.get_columns() for discipline, store in zip(self.disciplines, stores)}
+        rows = dict(zip(self.disciplines, matched_rows))
 
-        for discipline in self.disciplines:
-            data[discipline] = discipline.get_batched_samples()
-
-        sample_map = {}
-        sample_counter = 0
-        for run_id in initial_data:
-            initial_data[run_id] = dict(sorted(initial_data[run_id].items()))
-
-            for sample_in_run in initial_data[run_id]:
-                missing_sample = False
-                for discipline, data_disc in data.items():
-                    if sample_in_run not in data_disc[run_id]:
-                        missing_sample = True
-                        break
-                if missing_sample:
-                    continue
-
-                sample_map[sample_counter] = dict(run_id=run_id,
-                                                  sample_in_run=sample_in_run)
-                sample_counter += 1
-
-        input_data = {}
-        output_data = {}
-        for input_var, discipline in self.input_providers.items():
-            input_var_data = []
-            for sample_number, sample_location in sample_map.items():
-                run_id = sample_location['run_id']
-                sample_in_run = sample_location['sample_in_run']
-                input_var_data.append(data[discipline][run_id][sample_in_run]['input'][input_var])
-            input_data[input_var] = input_var_data
-
-        for output_var, discipline in self.output_providers.items():
-            output_var_data = []
-            for sample_number, sample_location in sample_map.items():
-                run_id = sample_location['run_id']
-                sample_in_run = sample_location['sample_in_run']
-                output_var_data.append(data[discipline][run_id][sample_in_run]['output'][output_var])
-            output_data[output_var] = output_var_data
+        self._merged_samples = set(sample_keys)
+        self._pending_samples = {discipline.uuid: self._get_unmatched_samples(store, rows[discipline])
+                                 for discipline, store in zip(self.disciplines, stores)}
 
         if self.converged:
-            input_data, output_data, sample_map = self._filter_converged_data(input_data, output_data, sample_map)
+            input_matrix = np.column_stack([np.reshape(columns[discipline][0][input_var][rows[discipline]],
+                                                       (len(sample_keys), -1))
+                                            for input_var, discipline in self.input_providers.items()])
+            converged_sample_numbers = self._filter_converged_data(self._converged_keys(input_matrix,
+                                                                                        reset_grid=True))
+            rows = {discipline: discipline_rows[converged_sample_numbers]
+                    for discipline, discipline_rows in rows.items()}
+            sample_keys = [sample_keys[sample_number] for sample_number in converged_sample_numbers]
+
+        input_data = {input_var: columns[discipline][0][input_var][rows[discipline]].tolist()
+                      for input_var, discipline in self.input_providers.items()}
+        output_data = {output_var: columns[discipline][1][output_var][rows[discipline]].tolist()
+                       for output_var, discipline in self.output_providers.items()}
 
         self.input_data = input_data
         self.output_data = output_data
-        self.n_total_samples = len(sample_map)
+        self.n_total_samples = len(sample_keys)
+        self.sample_keys = sample_keys
         self._process_data()
+        self._converged_rows = {tuple(row): idx_row for idx_row, row in
+                                enumerate(self._converged_keys(self.all_input_samples).tolist())} \
+            if self.converged else {}
 
         if self.n_total_samples > 0:
             self.update_hidden_constraints()
             self._calculate_non_linearity()
 
-    def _filter_converged_data(self, input_data, output_data, old_sample_map):
-        unique_input_samples = []
-        converged_sample_numbers = []
-        new_sample_map = {}
-        for sample_number in old_sample_map:
-            input_sample = {}
-            for var in input_data:
-                input_sample[var] = input_data[var][sample_number]
-
-            if input_sample not in unique_input_samples:
-                unique_input_samples.append(input_sample)
-                converged_sample_numbers.append(sample_number)
-                new_sample_map[len(unique_input_samples) - 1] = dict(run_id=old_sample_map[sample_number]['run_id'],
-                                                                     sample_in_run=old_sample_map[sample_number][
-                                                                         'sample_in_run'])
+    @staticmethod
+    def _join_samples(stores: list):
+        """Match the samples in the column stores of the disciplines on run_id and sample_in_run.
+
+        Run ids are coded in order of their first appearance and every sample gets a key run code << 32 |
+        sample_in_run, so the join is an intersection of integer arrays. When a store has multiple samples with the same
+        key, the last one is used.
+
+        :param stores: ColumnStore per discipline
+        :return: row indices of the matched samples per store, and (run_id, sample_in_run) of the matched samples. Both
+            are ordered on run and sample_in_run.
+        :rtype: [list[np.ndarray], list[tuple]]
+        """
+        run_codes = {}
+        for store in stores:
+            for run_id in store.run_ids:
+                run_codes.setdefault(run_id, len(run_codes))
+        run_ids = list(run_codes)
+
+        keys = []
+        for store in stores:
+            code_map = np.array([run_codes[run_id] for run_id in store.run_ids], dtype=np.int64)
+            keys.append((code_map[store.run_codes] << 32) | store.sample_in_run)
+
+        common_keys = np.unique(keys[0])
+        for store_keys in keys[1:]:
+            common_keys = np.intersect1d(common_keys, store_keys)
+
+        matched_rows = []
+        for store_keys in keys:
+            unique_keys, last_reversed = np.unique(store_keys[::-1], return_index=True)
+            last_rows = len(store_keys) - 1 - last_reversed
+            matched_rows.append(last_rows[np.searchsorted(unique_keys, common_keys)])
+
+        return matched_rows, [(run_ids[key >> 32], key & 0xFFFFFFFF) for key in common_keys.tolist()]
+
+    @staticmethod
+    def _get_unmatched_samples(store, matched_rows: np.ndarray) -> dict:
+        """Get the samples in a column store that are not matched with the other disciplines (yet).
+
+        :return: {(run_id, sample_in_run): {'input': {'variable': value}, 'output': {'variable': value}}}
+        :rtype: dict
+        """
+        unmatched = np.ones(store.n_samples, dtype=bool)
+        unmatched[matched_rows] = False
+        unmatched_rows = np.flatnonzero(unmatched)
+
+        inputs, outputs = store.get_columns()
+        inputs = {variable: values[unmatched_rows].tolist() for variable, values in inputs.items()}
+        outputs = {variable: values[unmatched_rows].tolist() for variable, values in outputs.items()}
+        return {(store.run_ids[store.run_codes[row]], int(store.sample_in_run[row])):
+                dict(input={variable: values[idx] for variable, values in inputs.items()},
+                     output={variable: values[idx] for variable, values in outputs.items()})
+                for idx, row in enumerate(unmatched_rows)}
+
+    def _merge_new_samples(self):
+        """Merge the samples that are added to the disciplines since the last update into the data.
+
+        Only the change feed of every discipline is fetched (see Discipline.get_samples_since). Samples are matched on
+        run_id and sample number in run; samples that are not available for all disciplines yet are kept until they
+        are. The matched rows are appended to the input and output matrices, or for converged surrogate models replace
+        the row with identical inputs. Validity for the hidden constraints and the non-linearity are updated for the
+        new rows only. New rows are appended in order of arrival, not in order of run as after a full update.
+
+        :return: False if the data has to be rebuilt instead, e.g. because samples are deleted
+        :rtype: bool
+        """
+        if self._pending_samples is None or self.n_total_samples == 0 or self._linear_fit_sums is None:
+            return False
+        if any(hidden_constraint not in self.hidden_constraints
+               for discipline in self.disciplines for hidden_constraint in discipline.hidden_constraints):
+            return False
+
+        synced_seqs = {}
+        new_keys = set()
+        for discipline in self.disciplines:
+            if discipline.uuid not in self.synced_seqs:
+                return False
+            samples, seq, full = discipline.get_samples_since(self.synced_seqs[discipline.uuid])
+            synced_seqs[discipline.uuid] = seq
+            if full:
+                return False
+
+            for sample in samples:
+                key = (sample['run_id'], sample['sample_in_run'])
+                if key not in self._merged_samples:
+                    self._pending_samples[discipline.uuid][key] = sample
+                    new_keys.add(key)
+
+        pending = [self._pending_samples[discipline.uuid] for discipline in self.disciplines]
+        matched_keys = [key for key in pending[0] if key in new_keys and all(key in samples for samples in pending)]
+
+        input_rows = {variable: [self._pending_samples[discipline.uuid][key]['input'][variable]
+                                 for key in matched_keys] for variable, discipline in self.input_providers.items()}
+        output_rows = {variable: [self._pending_samples[discipline.uuid][key]['output'][variable]
+                                  for key in matched_keys] for variable, discipline in self.output_providers.items()}
+        for samples in pending:
+            for key in matched_keys:
+                del samples[key]
+
+        self.synced_seqs = synced_seqs
+        if not matched_keys:
+            return True
+
+        new_input_samples = self._flatten_rows(input_rows, len(matched_keys), self.input_samples_indices,
+                                               self.input_vector_indices)
+        new_output_samples = self._flatten_rows(output_rows, len(matched_keys), self.output_samples_indices,
+                                                self.output_vector_indices)
+        if self.converged and not self._in_iteration_grid(new_input_samples):
+            return False
+        self._merged_samples.update(matched_keys)
+
+        # Rows with inputs identical to an existing row replace that row when converged
+        new_rows = []
+        replaced_rows = {}
+        converged_keys = self._converged_keys(new_input_samples).tolist() if self.converged else None
+        for idx_new, key in enumerate(matched_keys):
+            row = tuple(converged_keys[idx_new]) if self.converged else None
+            if row in self._converged_rows and self._converged_rows[row] >= self.n_total_samples:
+                new_rows[self._converged_rows[row] - self.n_total_samples] = idx_new
+            elif row in self._converged_rows:
+                replaced_rows[self._converged_rows[row]] = idx_new
             else:
-                idx_unique_sample = unique_input_samples.index(input_sample)
-                converged_sample_numbers[idx_unique_sample] = sample_number
-                new_sample_map[idx_unique_sample] = dict(run_id=old_sample_map[sample_number]['run_id'],
-                                                         sample_in_run=old_sample_map[sample_number]['sample_in_run'])
+                if self.converged:
+                    self._converged_rows[row] = self.n_total_samples + len(new_rows)
+                new_rows.append(idx_new)
+
+        invalid_samples = set(self.invalid_samples)
+        for idx_row, idx_new in replaced_rows.items():
+            if idx_row not in invalid_samples:
+                self._update_linear_fit_sums(self.all_input_samples[[idx_row]], self.all_output_samples[[idx_row]],
+                                             sign=-1)
+            invalid_samples.discard(idx_row)
+            self.sample_keys[idx_row] = matched_keys[idx_new]
+        self.all_input_samples[list(replaced_rows)] = new_input_samples[list(replaced_rows.values())]
+        self.all_output_samples[list(replaced_rows)] = new_output_samples[list(replaced_rows.values())]
+
+        self.all_input_samples = np.vstack([self.all_input_samples, new_input_samples[new_rows]])
+        self.all_output_samples = np.vstack([self.all_output_samples, new_output_samples[new_rows]])
+        self.sample_keys.extend(matched_keys[idx_new] for idx_new in new_rows)
+        for variable, values in input_rows.items():
+            self.input_data[variable] = self._merge_column(self.input_data[variable], values, replaced_rows, new_rows)
+        for variable, values in output_rows.items():
+            self.output_data[variable] = self._merge_column(self.output_data[variable], values, replaced_rows, new_rows)
+
+        changed_rows = list(replaced_rows) + list(range(self.n_total_samples, self.n_total_samples + len(new_rows)))
+        self.n_total_samples = len(self.all_input_samples)
+        valid = self._valid_samples(self.all_input_samples[changed_rows], self.all_output_samples[changed_rows])
+        invalid_samples.update(idx_row for idx_row, valid_row in zip(changed_rows, valid) if not valid_row)
+        self.invalid_samples = np.array(sorted(invalid_samples), dtype=int)
+
+        valid_rows = [idx_row for idx_row, valid_row in zip(changed_rows, valid) if valid_row]
+        self._update_linear_fit_sums(self.all_input_samples[valid_rows], self.all_output_samples[valid_rows])
+        if replaced_rows:
+            valid_samples = np.ones(self.n_total_samples, dtype=bool)
+            valid_samples[self.invalid_samples] = False
+            self.valid_input_samples = self.all_input_samples[valid_samples]
+            self.valid_output_samples = self.all_output_samples[valid_samples]
+        else:
+            self.valid_input_samples = np.vstack([self.valid_input_samples, self.all_input_samples[valid_rows]])
+            self.valid_output_samples = np.vstack([self.valid_output_samples, self.all_output_samples[valid_rows]])
+        self.n_valid_samples = len(self.valid_input_samples)
+        self._non_linearity_from_linear_fit_sums()
+
+        print(f'Merged {len(matched_keys)} new samples into the data of the surrogate model '
+              f'({self.n_total_samples} samples)')
+        return True
+
+    @staticmethod
+    def _merge_column(column: list, values: list, replaced_rows: dict, new_rows: list) -> list:
+        """Merge the new values of a variable into its column of the data {variable: list}"""
+        for idx_row, idx_new in replaced_rows.items():
+            column[idx_row] = values[idx_new]
+        column.extend(values[idx_new] for idx_new in new_rows)
+        return column
 
-        for var in input_data:
-            input_data[var] = [input_data[var][idx] for idx in converged_sample_numbers]
+    @property
+    def is_up_to_date(self):
+        """Check whether the samples of the disciplines changed since the last update of the data"""
+        return all(self.synced_seqs.get(discipline.uuid) == discipline.sample_seq for discipline in self.disciplines)
+
+    def _converged_keys(self, input_matrix: np.ndarray, reset_grid: bool = False) -> np.ndarray:
+        """Rows on which the samples of a converged surrogate model are compared, see _filter_converged_data.
+
+        By default these are the inputs, so only the last iteration of the converger is kept per input. Iterations of a
+        single discipline with different inputs are all kept, as its inputs include the coupling variables. When
+        thin_iterations is set, inputs are snapped to a grid with a step of iteration_tolerance times the range of every
+        input, so iterations that (nearly) converged are thinned to the last of them. This only ever removes samples.
+        Near-identical iterations on either side of a cell boundary are not merged. The grid is fitted to the range of
+        the inputs at a full update of the data. Merging new samples outside that range would depend on the order of
+        the updates, so these trigger a full update instead (see _in_iteration_grid).
+
+        :param input_matrix: (n_samples, n_columns) inputs of the samples
+        :param reset_grid: fit the grid to the range of the inputs
+        :rtype: np.ndarray
+        """
+        if not self.thin_iterations or self.iteration_tolerance <= 0 or len(input_matrix) == 0:
+            return input_matrix
+
+        if reset_grid or self._iteration_grid is None:
+            input_range = np.ptp(input_matrix, axis=0)
+            self._iteration_grid = (np.min(input_matrix, axis=0),
+                                    np.where(input_range > 0, input_range * self.iteration_tolerance, 1.),
+                                    np.max(input_matrix, axis=0))
+
+        shift, step, _ = self._iteration_grid
+        return np.round((input_matrix - shift) / step)
+
+    def _in_iteration_grid(self, input_matrix: np.ndarray) -> bool:
+        """Whether samples lie within the range to which the grid of _converged_keys is fitted, so a full update would
+        fit the same grid. Always True when iterations are not thinned.
+
+        :param input_matrix: (n_samples, n_columns) inputs of the samples
+        :rtype: bool
+        """
+        if not self.thin_iterations or self.iteration_tolerance <= 0 or self._iteration_grid is None:
+            return True
+
+        minimum, _, maximum = self._iteration_grid
+        return bool(np.all((input_matrix >= minimum) & (input_matrix <= maximum)))
+
+    @staticmethod
+    def _filter_converged_data(input_matrix: np.ndarray) -> np.ndarray:
+        """Select one sample per unique input, the last sample with that input. Samples are ordered on the first
+        occurrence of their input.
 
-        for var in output_data:
-            output_data[var] = [output_data[var][idx] for idx in converged_sample_numbers]
+        :param input_matrix: (n_samples, n_columns) inputs of the samples
+        :return: numbers of the selected samples
+        :rtype: np.ndarray
+        """
+        if len(input_matrix) == 0:
+            return np.zeros(0, dtype=int)
 
-        return input_data, output_data, new_sample_map
+        # Adding 0. turns -0. into 0., rows are compared on their bytes
+        _, first_samples, inverse = np.unique(input_matrix + 0., axis=0, return_index=True, return_inverse=True)
+        last_samples = np.zeros(len(first_samples), dtype=int)
+        np.maximum.at(last_samples, inverse.ravel(), np.arange(len(input_matrix)))
+        return last_samples[np.argsort(first_samples)]
 
     def update_hidden_constraints(self):
         for discipline in self.disciplines:
@@ -304,6 +522,7 @@ class SurrogateModel(DesignCompetence):
             self.hidden_constraints = [hidden_constraint]
         else:
             self.hidden_constraints.append(hidden_constraint)
+        self.hidden_constraint_override = None
 
         if filter_data:
             self._filter_hidden_constraints()
@@ -320,55 +539,111 @@ class SurrogateModel(DesignCompetence):
     def predict(self, input_data: dict):
         """Predict the model's response for a set of input data.
 
-        Input data has the format of ['varName': data, 'varName2': data2]. Return has identical structure.
+        Input data has the format of ['varName': data, 'varName2': data2]. Return has identical structure. Vector
+        variables are given and returned as arrays.
 
         :param input_data: inputs for prediction
         :type input_data: dict
         :return: predicted response
         :rtype: dict
         """
+        return {variable: values[0] for variable, values in self.predict_batch(input_data).items()}
 
-        assert self.surrogate is not None, "Surrogate model is not trained. Call surrogate_model.build() first."
+    def predict_batch(self, input_data):
+        """Predict the model's response for a batch of samples at once.
 
-        predict_input = np.zeros((1, self.input_dimension))
+        The surrogate and the hidden constraint classifier are evaluated once for the whole batch, which is much
+        faster than calling predict per sample (e.g. to evaluate the surrogate on a grid).
 
-        # Ensure order of input vector is correct
-        for variable, index in self.input_samples_indices.items():
-            predict_input[0, index] = input_data[variable]
+        :param input_data: (n, input_dimension) array with the columns ordered as input_samples_indices, or
+            {'varName': array} with n values per variable, (n, size) for vector variables
+        :type input_data: np.ndarray | dict
+        :return: predicted response {'varName': array}, (n,) for scalar variables and (n, size) for vector variables
+        :rtype: dict
+        """
+
+        assert self.surrogate is not None, "Surrogate model is not trained. Call surrogate_model.build() first."
+
+        if isinstance(input_data, dict):
+            predict_input = self._build_input_matrix(input_data)
+        else:
+            predict_input = np.atleast_2d(np.asarray(input_data, dtype=float))
+        assert predict_input.shape[1] == self.input_dimension, \
+            f"Input has {predict_input.shape[1]} columns, {self.input_dimension} expected"
 
         predict_output = self.surrogate.predict_values(predict_input)
 
+        # Check which samples violate the hidden constraints, and apply the actions of the hidden constraints to them
+        if len(self.hidden_constraints) > 0:
+            violated = np.asarray(self.hidden_constraints_predictor.predict(predict_input), dtype=bool)
+        else:
+            violated = np.zeros(len(predict_input), dtype=bool)
+
+        if np.any(violated):
+            if getattr(self, 'hidden_constraint_override', None) is None:
+                self.update_hidden_constraint_override()
+            override_columns, override_values, other_overrides = self.hidden_constraint_override
+            predict_output[np.ix_(violated, override_columns)] = override_values
+
         output = dict()
+        output_vector_indices = getattr(self, 'output_vector_indices', {})
+        element_indices = {index for indices in output_vector_indices.values() for index in indices}
         for variable, index in self.output_samples_indices.items():
-            output[variable] = predict_output[0, index]
+            if index not in element_indices:
+                output[variable] = predict_output[:, index]
+        for variable, indices in output_vector_indices.items():
+            output[variable] = predict_output[:, indices]
 
-        # Check if hidden constraints are violated.
-        if len(self.hidden_constraints) > 0:
-            violated_hidden_constraint = self.hidden_constraints_predictor.predict(predict_input)
-        else:
-            violated_hidden_constraint = False
-
-        # And handle the violated hidden constraints if necessary
-        if violated_hidden_constraint:
-            for hidden_constraint in self.hidden_constraints:
-                for action in hidden_constraint.actions:
-                    if action['action'] == 'set_variable_to_value':
-                        for action_var in action:
-                            if action_var == 'action':
-                                continue
-                            else:
-                                output[action_var] = action[action_var]
-
-                    elif action['action'] == 'set_variables_to_value_from_file':
-                        file = action['filename']
-                        assert os.path.isfile(file), "Provided file for resetting the variables to file is not valid."
-
-                        reset_data = PortableCpacs(file)
-                        for variable_to_reset in action['variables_to_reset']:
-                            output[variable_to_reset] = reset_data.get_value(variable_to_reset)
+        if np.any(violated):
+            for variable, value in other_overrides.items():
+                self._set_masked(output, variable, violated, value)
 
         return output
 
+    def update_hidden_constraint_override(self):
+        """Resolve the actions of the hidden constraints into the values that are assigned to violating predictions.
+
+        Reset files of 'set_variables_to_value_from_file' actions are read once here instead of for every
+        prediction. Values of output variables are stored as override vector over the output columns, so applying
+        the actions to a batch is a single masked assignment. Actions are applied in order, later actions overwrite
+        earlier ones.
+        """
+        values = dict()
+        for hidden_constraint in self.hidden_constraints:
+            for action in hidden_constraint.actions:
+                if action['action'] == 'set_variable_to_value':
+                    for action_var in action:
+                        if action_var == 'action':
+                            continue
+                        else:
+                            values[action_var] = action[action_var]
+
+                elif action['action'] == 'set_variables_to_value_from_file':
+                    file = action['filename']
+                    assert os.path.isfile(file), "Provided file for resetting the variables to file is not valid."
+
+                    reset_data = PortableCpacs(file)
+                    for variable_to_reset in action['variables_to_reset']:
+                        values[variable_to_reset] = reset_data.get_value(variable_to_reset)
+
+        override_columns = []
+        override_values = []
+        other_overrides = dict()  # Variables that are not an output of the surrogate
+        output_vector_indices = getattr(self, 'output_vector_indices', {})
+        for variable, value in values.items():
+            if variable in output_vector_indices:
+                override_columns.extend(output_vector_indices[variable])
+                override_values.extend(np.broadcast_to(value, len(output_vector_indices[variable])))
+            elif self.output_samples_indices and variable in self.output_samples_indices:
+                override_columns.append(self.output_samples_indices[variable])
+                override_values.append(value)
+            else:
+                other_overrides[variable] = value
+
+        self.hidden_constraint_override = (np.array(override_columns, dtype=int),
+                                           np.array(override_values, dtype=float),
+                                           other_overrides)
+
     def propose_new_sample_grid(self, combine=True, method='EIGF', n_samples=None, seed=None):
         variable_bounds = self.input_bounds
         limits = np.zeros((self.input_dimension, 2))
@@ -575,7 +850,21 @@ class SurrogateModel(DesignCompetence):
             RC = predicted_variance
         return -1 * RC[0, self.output_samples_indices[output_variable]]
 
+    def build_response_writer(self, template_cpacs: str = None):
+        """Precompute the locations of the inputs and outputs for write_cpacs_response, to be called at deployment.
+
+        :param template_cpacs: CPACS file with the same layout as the input files of the deployed surrogate model
+        :type template_cpacs: str
+        """
+        self.response_writer = CpacsResponseWriter(input_xpaths=self.input_variables,
+                                                   output_xpaths=self.output_variables,
+                                                   template_cpacs=template_cpacs)
+
     def write_cpacs_response(self, cpacs_in: str, cpacs_out: str):
+        if getattr(self, 'response_writer', None) is not None:
+            self.response_writer.write(cpacs_in=cpacs_in, cpacs_out=cpacs_out, predict=self.predict)
+            return
+
         cpacs = PortableCpacs(cpacs_in)
 
         cpacs_input = {}
@@ -594,9 +883,8 @@ class SurrogateModel(DesignCompetence):
 
         :return:
         """
-        samples_violating_constraints = []
-        for idx_sample in range(0, self.n_total_samples):
-            samples_violating_constraints.append(idx_sample in self.invalid_samples)
+        samples_violating_constraints = np.zeros(self.n_total_samples, dtype=bool)
+        samples_violating_constraints[self.invalid_samples] = True
 
         random_forest = RandomForestClassifier(n_jobs=-1, oob_score=True)
         random_forest.fit(self.all_input_samples, samples_violating_constraints)
@@ -605,18 +893,29 @@ class SurrogateModel(DesignCompetence):
 
     @property
     def input_dimension(self):
-        if self.input_data:
+        """Amount of input columns, vector variables have a column per element"""
+        if self.input_samples_indices:
+            return len(self.input_samples_indices)
+        elif self.input_data:
             return len(self.input_data)
         else:
             return None
 
     @property
     def output_dimension(self):
-        if self.output_data:
+        """Amount of output columns, vector variables have a column per element"""
+        if self.output_samples_indices:
+            return len(self.output_samples_indices)
+        elif self.output_data:
             return len(self.output_data)
         else:
             return None
 
+    @staticmethod
+    def vector_element(variable: str, index: int) -> str:
+        """Name of the column of an element of a vector variable"""
+        return f'{variable}#{index}'
+
     @property
     def input_bounds(self):
         bounds = {}
@@ -734,38 +1033,68 @@ class SurrogateModel(DesignCompetence):
         101123–101123, 2020. doi: 10.1016/j.aei.2020.101123. URL https://doi.org/10.1016/j.aei.
         2020.101123
 
+        The linear model is fitted from the sums of its normal equations (see _update_linear_fit_sums), so the
+        non-linearity is updated for new samples without fitting on all samples again.
         """
-        lin_model = smt.LS(print_global=False)
-        lin_model.set_training_values(xt=self.valid_input_samples,
-                                      yt=self.valid_output_samples)
-        lin_model.train()
-
-        lin_prediction = lin_model.predict_values(self.valid_input_samples)
-
-        # Numpy combines the correlation coefficient in a matrix. it has the format:
-        #            y_hat_1, ..., y_hat_N , y_1, ..., y_N
-        # -------------------------------------
-        # y_hat_1   |
-        # ...       |
-        # y_hat_N   |
-        # y_1       |
-        # ...       |
-        # y_N       |
-
-        corr_coef_matrix = np.corrcoef(lin_prediction, self.valid_output_samples, rowvar=False)
+        self._linear_fit_sums = None
+        self._update_linear_fit_sums(self.valid_input_samples, self.valid_output_samples)
+        self._non_linearity_from_linear_fit_sums()
+
+    def _update_linear_fit_sums(self, input_samples: np.ndarray, output_samples: np.ndarray, sign: int = 1):
+        """Add samples to (or with sign=-1 remove samples from) the sums of the normal equations of a linear fit of the
+        outputs on the inputs. Inputs and outputs are shifted and scaled with the statistics of the first samples, to
+        keep the normal equations well conditioned.
+        """
+        if len(input_samples) == 0:
+            return
+
+        if self._linear_fit_sums is None:
+            input_scale = np.std(input_samples, axis=0)
+            output_scale = np.std(output_samples, axis=0)
+            self._linear_fit_sums = dict(input_shift=np.mean(input_samples, axis=0),
+                                         input_scale=np.where(input_scale > 0, input_scale, 1.),
+                                         output_shift=np.mean(output_samples, axis=0),
+                                         output_scale=np.where(output_scale > 0, output_scale, 1.),
+                                         n=0,
+                                         xx=np.zeros((input_samples.shape[1] + 1, input_samples.shape[1] + 1)),
+                                         xy=np.zeros((input_samples.shape[1] + 1, output_samples.shape[1])),
+                                         y=np.zeros(output_samples.shape[1]),
+                                         yy=np.zeros(output_samples.shape[1]))
+
+        sums = self._linear_fit_sums
+        x = np.hstack([np.ones((len(input_samples), 1)), (input_samples - sums['input_shift']) / sums['input_scale']])
+        y = (output_samples - sums['output_shift']) / sums['output_scale']
+        sums['n'] += sign * len(x)
+        sums['xx'] += sign * x.T @ x
+        sums['xy'] += sign * x.T @ y
+        sums['y'] += sign * np.sum(y, axis=0)
+        sums['yy'] += sign * np.sum(y ** 2, axis=0)
+
+    def _non_linearity_from_linear_fit_sums(self):
+        """Calculate the non-linearity 1 - corr(y_hat, y) per output from the sums of the linear fit"""
+        sums = self._linear_fit_sums
+        coefficients = np.linalg.lstsq(sums['xx'], sums['xy'], rcond=None)[0]
+
+        n = sums['n']
+        mean_prediction = sums['xx'][0] @ coefficients / n
+        mean_output = sums['y'] / n
+        covariance = np.sum(coefficients * sums['xy'], axis=0) / n - mean_prediction * mean_output
+        var_prediction = np.einsum('ij,ik,kj->j', coefficients, sums['xx'], coefficients) / n - mean_prediction ** 2
+        var_output = sums['yy'] / n - mean_output ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr_coef = covariance / np.sqrt(var_prediction * var_output)
+
         self.output_non_linearity = {}
         for var in self.output_samples_indices:
             idx = self.output_samples_indices[var]
-            i = idx
-            j = self.output_dimension + idx
-            self.output_non_linearity[var] = 1 - corr_coef_matrix[i, j]  # Closer to 1: higher non-linearity
+            self.output_non_linearity[var] = 1 - corr_coef[idx]  # Closer to 1: higher non-linearity
 
     def _filter_hidden_constraints(self):
         if self.n_total_samples == 0 or not self.hidden_constraints:
             self.valid_input_samples = self.all_input_samples
             self.valid_output_samples = self.all_output_samples
             self.n_valid_samples = len(self.valid_input_samples)
-            self.invalid_samples = []
+            self.invalid_samples = np.zeros(0, dtype=int)
             return
 
         self.hidden_constraint_input_indices = []
@@ -781,41 +1110,36 @@ class SurrogateModel(DesignCompetence):
                 if flag in self.output_samples_indices:
                     self.hidden_constraint_output_indices.append(self.output_samples_indices[flag])
 
-        valid_samples = []
-        invalid_samples = []
-        for idx_sample in range(0, self.n_total_samples):
-            valid = False
-            for hidden_constraint in self.hidden_constraints:
-                if not hidden_constraint.ignore_in_training:
-                    valid = True
-                    continue
-                for flag in hidden_constraint.flags:
-                    if flag in self.input_samples_indices:
-                        sample_flag_val = self.all_input_samples[idx_sample, self.input_samples_indices[flag]]
-                    elif flag in self.output_samples_indices:
-                        sample_flag_val = self.all_output_samples[idx_sample, self.output_samples_indices[flag]]
-                    else:
-                        valid = True
-                        continue
+        valid = self._valid_samples(self.all_input_samples, self.all_output_samples)
+        self.invalid_samples = np.flatnonzero(~valid)
 
-                    if sample_flag_val == hidden_constraint.flags[flag]:
-                        valid = False
-                        break
-                    else:
-                        valid = True
+        # Without invalid samples, the valid samples are the full matrices instead of copies
+        if len(self.invalid_samples) == 0:
+            self.valid_input_samples = self.all_input_samples
+            self.valid_output_samples = self.all_output_samples
+        else:
+            self.valid_input_samples = self.all_input_samples[valid]
+            self.valid_output_samples = self.all_output_samples[valid]
+        self.n_valid_samples = len(self.valid_input_samples)
 
-                if not valid:
-                    break
+    def _valid_samples(self, input_samples: np.ndarray, output_samples: np.ndarray) -> np.ndarray:
+        """Check which samples do not violate the hidden constraints that are ignored in training. A sample violates a
+        hidden constraint when one of its flag variables equals the flag value.
 
-            if valid:
-                valid_samples.append(idx_sample)
-            else:
-                invalid_samples.append(idx_sample)
+        :return: boolean per sample, True if valid
+        :rtype: np.ndarray
+        """
+        valid_samples = np.ones(len(input_samples), dtype=bool)
+        for hidden_constraint in self.hidden_constraints:
+            if not hidden_constraint.ignore_in_training:
+                continue
+            for flag, flag_value in hidden_constraint.flags.items():
+                if flag in self.input_samples_indices:
+                    valid_samples &= input_samples[:, self.input_samples_indices[flag]] != flag_value
+                elif flag in self.output_samples_indices:
+                    valid_samples &= output_samples[:, self.output_samples_indices[flag]] != flag_value
 
-        self.valid_input_samples = np.take(self.all_input_samples, valid_samples, 0)
-        self.valid_output_samples = np.take(self.all_output_samples, valid_samples, 0)
-        self.n_valid_samples = len(valid_samples)
-        self.invalid_samples = invalid_samples
+        return valid_samples
 
     def _evaluate_candidates(self, candidates, parallel=True):
         """Evaluate a set of candidates.
@@ -906,25 +1230,79 @@ class SurrogateModel(DesignCompetence):
 
     def _process_data(self):
         """Prepare incoming data for the SMT format (numpy).
+
+        Vector variables are flattened into a column per element (see vector_element). The columns of every vector
+        variable are stored in input_vector_indices and output_vector_indices {variable: [column indices]}.
         """
         # Store in SMT specific format
-        self.all_input_samples = np.zeros((self.n_total_samples, self.input_dimension))
-        self.input_samples_indices = dict()
-        for index, variable in enumerate(self.input_data):
-            assert len(
-                self.input_data[variable]) == self.n_total_samples, "Sample size should be equal for all variables"
-
-            self.input_samples_indices[variable] = index
-            self.all_input_samples[:, index] = self.input_data[variable]
-
-        self.all_output_samples = np.zeros((self.n_total_samples, self.output_dimension))
-        self.output_samples_indices = dict()
-        for index, variable in enumerate(self.output_data):
-            assert len(
-                self.output_data[variable]) == self.n_total_samples, "Sample size should be equal for all variables"
-
-            self.output_samples_indices[variable] = index
-            self.all_output_samples[:, index] = self.output_data[variable]
+        self.all_input_samples, self.input_samples_indices, self.input_vector_indices = \
+            self._flatten_data(self.input_data)
+        self.all_output_samples, self.output_samples_indices, self.output_vector_indices = \
+            self._flatten_data(self.output_data)
+        self.hidden_constraint_override = None
+
+    def _flatten_data(self, data: dict):
+        """Build a matrix with a column per scalar variable and per element of vector variables.
+
+        :return: matrix, column index per column name, column indices per vector variable
+        :rtype: [np.ndarray, dict, dict]
+        """
+        blocks = []
+        indices = dict()
+        vector_indices = dict()
+        for variable, values in data.items():
+            assert len(values) == self.n_total_samples, "Sample size should be equal for all variables"
+
+            values = np.asarray(values, dtype=float)
+            if values.ndim == 1:
+                indices[variable] = len(indices)
+                blocks.append(values.reshape(-1, 1))
+                continue
+
+            vector_indices[variable] = []
+            for idx_element in range(values.shape[1]):
+                vector_indices[variable].append(len(indices))
+                indices[self.vector_element(variable, idx_element)] = len(indices)
+            blocks.append(values)
+
+        matrix = np.hstack(blocks) if blocks else np.zeros((self.n_total_samples, 0))
+        return matrix, indices, vector_indices
+
+    @staticmethod
+    def _flatten_rows(data: dict, n_rows: int, indices: dict, vector_indices: dict) -> np.ndarray:
+        """Build the matrix of new rows of data {variable: list} with the columns of the existing data."""
+        matrix = np.empty((n_rows, len(indices)))
+        for variable, values in data.items():
+            if variable in vector_indices:
+                values = np.asarray(values, dtype=float)
+                assert values.shape == (n_rows, len(vector_indices[variable])), \
+                    f"Size of vector variable {variable} differs from the existing samples"
+                matrix[:, vector_indices[variable]] = values
+            else:
+                matrix[:, indices[variable]] = values
+        return matrix
+
+    def _build_input_matrix(self, input_data: dict) -> np.ndarray:
+        """Build the (n, input_dimension) input matrix from a batch of input data {'varName': array}."""
+        input_vector_indices = getattr(self, 'input_vector_indices', {})
+        columns = [None] * self.input_dimension
+        for variable, index in self.input_samples_indices.items():
+            if variable in input_data:
+                columns[index] = np.atleast_1d(np.asarray(input_data[variable], dtype=float))
+        for variable, indices in input_vector_indices.items():
+            values = np.asarray(input_data[variable], dtype=float).reshape(-1, len(indices))
+            for idx_element, index in enumerate(indices):
+                columns[index] = values[:, idx_element]
+
+        assert all(column is not None for column in columns), "Input data is missing variables of the surrogate"
+        return np.column_stack(columns)
+
+    @staticmethod
+    def _set_masked(output: dict, variable: str, mask: np.ndarray, value):
+        """Set a variable of a batch of predictions {'varName': array} to a value for the samples in the mask."""
+        if variable not in output:
+            output[variable] = np.full((len(mask),) + np.shape(value), np.nan)
+        output[variable][mask] = value
 
     def _find_in_and_output_providers(self):
         """Find input and output providers from the provided in- and output variables.
@@ -195,15 +195,7 @@ class DisciplineAnalysis:
 
         :return: amount of non-static inputs for discipline
         """
-        input_samples, output_samples = self.discipline.get_all_samples()
-
-        n_varying_variables = 0
-        for variable in input_samples:
-            input_variable = input_samples[variable]
-            if not max(input_variable) - min(input_variable) == 0:
-                n_varying_variables += 1
-
-        return n_varying_variables
+        return len(self.discipline.get_non_constant_input_variables())
 
     @property
     def n_calls(self):
@@ -0,0 +1,262 @@
+import io
+import os
+import json
+import zlib
+import hashlib
+from collections import OrderedDict
+
+
+class FileArchive:
+    """Content-addressed archive for the files of runs, as alternative to storing the raw run folders.
+
+    Every file is stored once as object, named after the hash of its content, so identical files are deduplicated
+    within and across runs. Objects are compressed with zlib. Files that differ from an earlier file with the same name
+    in the run on a limited number of lines only (e.g. the CPACS files of the samples of a DoE) are stored as a line
+    delta against that file. A manifest per tool and run maps the relative paths of the files to their objects, which
+    gives random access to the files of any sample.
+
+    Folder structure:
+        objects/<hash[:2]>/<hash>
+        manifests/<tool_id>/<run_id>.json
+    """
+    full_object = b'F'
+    delta_object = b'D'
+    min_delta_size = 4096  # Smaller files are always stored in full
+    max_delta_fraction = 0.5  # Maximum fraction of changed lines for which a delta is stored
+    n_cached_bases = 8
+    mtime_resolution = 2.  # Seconds, coarsest resolution of file modification times on common file systems
+
+    def __init__(self, folder: str, compression_level: int = 6):
+        """
+        :param folder: location of the archive, created if it does not exist
+        :param compression_level: zlib compression level (1-9)
+        """
+        self.folder = folder
+        self.compression_level = compression_level
+        self._base_cache = OrderedDict()  # hash -> lines of recently used delta bases
+
+    @property
+    def objects_folder(self):
+        return os.path.join(self.folder, 'objects')
+
+    @property
+    def manifests_folder(self):
+        return os.path.join(self.folder, 'manifests')
+
+    def add_folder(self, folder: str, tool_id: str, run_id: str):
+        """Archive all files in a folder (recursively) as the files of a run of a tool. Files that are already in the
+        manifest of the run are replaced.
+
+        :param folder: folder of which the files are archived
+        :param tool_id: uuid of tool in database
+        :param run_id: uuid of run in database
+        :return: archived files {relative path: object hash}
+        :rtype: dict
+        """
+        manifest = self.get_manifest(tool_id, run_id)
+        delta_bases = {}  # (file name, amount of lines) -> hash of a fully stored object to store deltas against
+        n_bytes = 0
+
+        for base_folder, folders, files in os.walk(folder):
+            folders.sort()
+            for file in sorted(files):
+                path = os.path.join(base_folder, file)
+                with open(path, 'rb') as f:
+                    content = f.read()
+                n_bytes += len(content)
+
+                base_key = (file, content.count(b'\n'))
+                object_hash = self.add_file_content(content, delta_base=delta_bases.get(base_key))
+                if base_key not in delta_bases and self._is_full_object(object_hash):
+                    delta_bases[base_key] = object_hash
+
+                manifest[os.path.relpath(path, folder).replace(os.sep, '/')] = object_hash
+
+        self._write_manifest(tool_id, run_id, manifest)
+        print(f'Archived {len(manifest)} files ({n_bytes / 1e6:.1f} MB) of run {run_id} in {self.folder}')
+        return manifest
+
+    def add_file_content(self, content: bytes, delta_base: str = None) -> str:
+        """Store content as object, unless an identical object exists already.
+
+        :param content: content of file
+        :param delta_base: hash of a fully stored object to store the content as delta against, if worthwhile
+        :return: hash of object
+        :rtype: str
+        """
+        object_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+        object_path = self._object_path(object_hash)
+        try:
+            # Mark the existing object as used, so a concurrent collect_garbage does not remove it
+            os.utime(object_path)
+            return object_hash
+        except FileNotFoundError:
+            pass
+
+        data = None
+        if delta_base is not None and len(content) >= self.min_delta_size:
+            delta = self._build_delta(self._get_base_lines(delta_base), content.splitlines(keepends=True))
+            if delta is not None:
+                data = self.delta_object + delta_base.encode('ascii') + zlib.compress(
+                    json.dumps(delta, separators=(',', ':')).encode('utf-8'), self.compression_level)
+
+        if data is None:
+            data = self.full_object + zlib.compress(content, self.compression_level)
+
+        # Write to temporary file first, so no half-written object is ever visible under its hash
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with open(f'{object_path}.{os.getpid()}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{object_path}.{os.getpid()}.tmp', object_path)
+
+        return object_hash
+
+    def get_manifest(self, tool_id: str, run_id: str) -> dict:
+        """Get the archived files of a run of a tool.
+
+        :return: {relative path: object hash}, empty if the run is not archived
+        :rtype: dict
+        """
+        manifest_path = self._manifest_path(tool_id, run_id)
+        if not os.path.isfile(manifest_path):
+            return {}
+
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def list_runs(self):
+        """Get all archived runs.
+
+        :return: list of (tool_id, run_id)
+        :rtype: list[tuple[str, str]]
+        """
+        runs = []
+        if not os.path.isdir(self.manifests_folder):
+            return runs
+
+        for tool_id in sorted(os.listdir(self.manifests_folder)):
+            for manifest in sorted(os.listdir(os.path.join(self.manifests_folder, tool_id))):
+                if manifest.endswith('.json'):
+                    runs.append((tool_id, manifest[:-len('.json')]))
+        return runs
+
+    def read(self, tool_id: str, run_id: str, path: str) -> bytes:
+        """Read an archived file.
+
+        :param tool_id: uuid of tool in database
+        :param run_id: uuid of run in database
+        :param path: path of file relative to the archived folder, e.g. '0/Input/CPACS initial/cpacs_in.xml'
+        :rtype: bytes
+        """
+        manifest = self.get_manifest(tool_id, run_id)
+        assert path in manifest, f'{path} is not archived for tool {tool_id} in run {run_id}'
+        return self.read_object(manifest[path])
+
+    def open(self, tool_id: str, run_id: str, path: str):
+        """Open an archived file as a binary file object, e.g. to parse it with lxml."""
+        return io.BytesIO(self.read(tool_id, run_id, path))
+
+    def read_object(self, object_hash: str) -> bytes:
+        with open(self._object_path(object_hash), 'rb') as f:
+            data = f.read()
+
+        if data[:1] == self.full_object:
+            return zlib.decompress(data[1:])
+
+        base_hash = data[1:33].decode('ascii')
+        lines = list(self._get_base_lines(base_hash))
+        for idx_line, line in json.loads(zlib.decompress(data[33:])):
+            lines[idx_line] = line.encode('utf-8', 'surrogateescape')
+        return b''.join(lines)
+
+    def extract(self, tool_id: str, run_id: str, destination: str):
+        """Restore the archived files of a run of a tool in a destination folder."""
+        for path, object_hash in self.get_manifest(tool_id, run_id).items():
+            file_path = os.path.join(destination, *path.split('/'))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as f:
+                f.write(self.read_object(object_hash))
+
+    def remove_run(self, tool_id: str, run_id: str):
+        """Remove the manifest of a run. The objects are removed by collect_garbage when no other run uses them."""
+        manifest_path = self._manifest_path(tool_id, run_id)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+
+    def collect_garbage(self, modified_before: float = None):
+        """Remove all objects that are not used by any manifest, directly or as delta base.
+
+        Other processes can add runs while the garbage is collected, their objects are written (or reused) before their
+        manifest. Pass the time at which the collection started as modified_before, objects written or reused after it
+        are kept.
+
+        :param modified_before: only remove objects last modified before this time (time.time()), None for all objects
+        :return: amount of removed objects
+        :rtype: int
+        """
+        used_objects = set()
+        for tool_id, run_id in self.list_runs():
+            used_objects.update(self.get_manifest(tool_id, run_id).values())
+
+        for object_hash in list(used_objects):
+            with open(self._object_path(object_hash), 'rb') as f:
+                header = f.read(33)
+            if header[:1] == self.delta_object:
+                used_objects.add(header[1:].decode('ascii'))
+
+        n_removed = 0
+        if not os.path.isdir(self.objects_folder):
+            return n_removed
+
+        for prefix in os.listdir(self.objects_folder):
+            for object_file in os.listdir(os.path.join(self.objects_folder, prefix)):
+                if object_file in used_objects or object_file.endswith('.tmp'):
+                    continue
+
+                object_path = os.path.join(self.objects_folder, prefix, object_file)
+                if modified_before is not None and \
+                        os.path.getmtime(object_path) >= modified_before - self.mtime_resolution:
+                    continue
+                os.remove(object_path)
+                n_removed += 1
+
+        return n_removed
+
+    def _build_delta(self, base_lines: list[bytes], lines: list[bytes]):
+        """Line delta [[line index, line], ...] against a base with the same amount of lines. None if the files differ
+        too much, or in structure, for a delta to be worthwhile."""
+        if len(lines) != len(base_lines):
+            return None
+
+        delta = [[idx_line, line.decode('utf-8', 'surrogateescape')]
+                 for idx_line, (base_line, line) in enumerate(zip(base_lines, lines)) if line != base_line]
+        if len(delta) > self.max_delta_fraction * len(lines):
+            return None
+        return delta
+
+    def _get_base_lines(self, object_hash: str) -> list[bytes]:
+        if object_hash in self._base_cache:
+            self._base_cache.move_to_end(object_hash)
+        else:
+            self._base_cache[object_hash] = self.read_object(object_hash).splitlines(keepends=True)
+            if len(self._base_cache) > self.n_cached_bases:
+                self._base_cache.popitem(last=False)
+
+        return self._base_cache[object_hash]
+
+    def _is_full_object(self, object_hash: str) -> bool:
+        with open(self._object_path(object_hash), 'rb') as f:
+            return f.read(1) == self.full_object
+
+    def _object_path(self, object_hash: str) -> str:
+        return os.path.join(self.objects_folder, object_hash[:2], object_hash)
+
+    def _manifest_path(self, tool_id: str, run_id: str) -> str:
+        return os.path.join(self.manifests_folder, tool_id, f'{run_id}.json')
+
+    def _write_manifest(self, tool_id: str, run_id: str, manifest: dict):
+        manifest_path = self._manifest_path(tool_id, run_id)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(f'{manifest_path}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
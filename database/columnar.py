@@ -0,0 +1,463 @@
+import os
+import json
+
+import numpy as np
+
+
+class RunningStatistics:
+    """Count, minimum, maximum, mean and variance of a set of columns, updated as rows are added.
+
+    Batches of rows are merged with the parallel form of Welford's algorithm, which is numerically stable and costs
+    O(columns) per batch on top of a single pass over the new rows. NaN values (missing variables) are ignored."""
+    def __init__(self, n_columns: int):
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)  # Sum of squared differences from the mean
+        self.min = np.full(n_columns, np.inf)
+        self.max = np.full(n_columns, -np.inf)
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray):
+        statistics = cls(matrix.shape[1])
+        statistics.update(matrix)
+        return statistics
+
+    def update(self, rows: np.ndarray):
+        """Merge the statistics of new rows (2D array with a column per variable)."""
+        if rows.shape[0] == 0:
+            return
+
+        valid = ~np.isnan(rows)
+        count = valid.sum(axis=0)
+        values = np.where(valid, rows, 0.)
+        mean = values.sum(axis=0) / np.maximum(count, 1)
+        m2 = (np.where(valid, rows - mean, 0.) ** 2).sum(axis=0)
+
+        total = self.count + count
+        delta = mean - self.mean
+        fraction = np.divide(count, total, out=np.zeros(len(total)), where=total > 0)
+        self.mean = self.mean + delta * fraction
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * fraction
+        self.count = total
+
+        self.min = np.fmin(self.min, np.where(valid, rows, np.inf).min(axis=0))
+        self.max = np.fmax(self.max, np.where(valid, rows, -np.inf).max(axis=0))
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Population variance of every column, NaN for columns without values."""
+        return np.divide(self.m2, self.count, out=np.full(len(self.count), np.nan), where=self.count > 0)
+
+    @property
+    def is_constant(self) -> np.ndarray:
+        """Whether all values of a column are equal. Columns without values are constant."""
+        return ~(self.max > self.min)
+
+    def to_dict(self) -> dict:
+        return dict(count=self.count.tolist(), mean=self.mean.tolist(), m2=self.m2.tolist(),
+                    min=self.min.tolist(), max=self.max.tolist())
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        statistics = cls(len(data['count']))
+        statistics.count = np.array(data['count'], dtype=np.int64)
+        for name in ['mean', 'm2', 'min', 'max']:
+            setattr(statistics, name, np.array(data[name], dtype=float))
+        return statistics
+
+
+class ColumnStore:
+    """Columnar store of all the samples of a single tool.
+
+    Inputs and outputs are stored as float64 matrices in Fortran order, so every variable is a contiguous column. Next
+    to that, each sample has a run code (index in run_ids) and its sample_in_run. On disk the arrays are stored as .npy
+    files and opened with memory-mapping, which means the columns are returned as views without any per-sample Python
+    objects.
+
+    Samples added since the last save are written as a new segment next to the stored arrays, so a save costs I/O for
+    the new samples only. When the segments hold more samples than the base arrays, or samples are removed, all arrays
+    are written under a new generation number, so arrays that are still memory-mapped by earlier views never have to
+    be overwritten. The store records the version (sequence number) of the tool it reflects, which is used to detect
+    stores that are out of date because another process changed the samples.
+
+    Running statistics (count, minimum, maximum, mean and variance) of every variable are maintained as samples are
+    added and stored with the meta data, so they are available without a pass over the samples.
+
+    Vector variables (stored as lists in the samples) occupy a block of adjacent columns. Their length is fixed by the
+    first samples that are added to an empty store."""
+    initial_capacity = 64
+    max_segments = 16  # Write all arrays under a new generation when more segments are stored
+    meta_file = 'meta.json'
+    array_names = ['input', 'output', 'run_code', 'sample_in_run']
+
+    def __init__(self, folder: str, inputs: list[str], outputs: list[str]):
+        self.folder = folder
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.input_sizes = dict.fromkeys(self.inputs, 1)  # Amount of columns of every variable, more for vectors
+        self.output_sizes = dict.fromkeys(self.outputs, 1)
+        self.input_indices = None  # variable -> index of first column
+        self.output_indices = None
+        self._update_indices()
+
+        self.n_samples = 0
+        self.seq = 0  # Version of the tool in the sample database that this store reflects
+        self.run_ids = []
+        self._run_codes = {}
+
+        self._input = np.empty((self.initial_capacity, self.n_input_columns), order='F')
+        self._output = np.empty((self.initial_capacity, self.n_output_columns), order='F')
+        self._run_code = np.empty(self.initial_capacity, dtype=np.int32)
+        self._sample_in_run = np.empty(self.initial_capacity, dtype=np.int64)
+
+        self.input_statistics = RunningStatistics(self.n_input_columns)
+        self.output_statistics = RunningStatistics(self.n_output_columns)
+
+        self._generation = 0
+        self._segments = []  # Numbers of the segments stored after the base arrays of the generation
+        self._n_base = 0  # Amount of samples in the stored base arrays
+        self._n_saved = 0  # Amount of samples in the stored base arrays and segments
+        self._dirty = False
+
+    @classmethod
+    def load(cls, folder: str, inputs: list[str], outputs: list[str]):
+        """Open a stored column store using memory-mapping.
+
+        :return: ColumnStore, or None if nothing is stored or the stored variables do not match
+        :rtype: ColumnStore
+        """
+        meta = cls._read_meta(folder)
+        if meta is None or 'seq' not in meta:
+            return None
+
+        if meta['inputs'] != list(inputs) or meta['outputs'] != list(outputs):
+            return None
+
+        store = cls(folder, inputs, outputs)
+        store.input_sizes = meta.get('input_sizes', store.input_sizes)
+        store.output_sizes = meta.get('output_sizes', store.output_sizes)
+        store._update_indices()
+        store._generation = meta['generation']
+        store._segments = meta.get('segments', [])
+        store.n_samples = meta['n_samples']
+        store._n_base = meta.get('n_base', store.n_samples)
+        store._n_saved = store.n_samples
+        store.seq = meta['seq']
+        store.run_ids = meta['run_ids']
+        store._run_codes = {run_id: code for code, run_id in enumerate(store.run_ids)}
+
+        try:
+            store._input, store._output, store._run_code, store._sample_in_run = \
+                [store._load_array(name) for name in cls.array_names]
+        except (OSError, ValueError):
+            return None
+
+        if 'statistics' in meta:
+            store.input_statistics = RunningStatistics.from_dict(meta['statistics']['input'])
+            store.output_statistics = RunningStatistics.from_dict(meta['statistics']['output'])
+        else:  # Stored before statistics were maintained
+            store._compute_statistics()
+
+        return store
+
+    def append(self, run_id: str, sample_in_run: int, input_data: dict, output_data: dict):
+        """Append a single sample. Variables that are missing in the sample are stored as NaN."""
+        self.extend([run_id], [sample_in_run], [input_data], [output_data])
+
+    def extend(self, run_ids: list[str], sample_in_run: list[int], input_data: list[dict], output_data: list[dict]):
+        """Append multiple samples at once. Variables that are missing in a sample are stored as NaN.
+
+        :param run_ids: run_id per sample
+        :param sample_in_run: sample_in_run per sample
+        :param input_data: input dict per sample
+        :param output_data: output dict per sample
+        """
+        n_new = len(run_ids)
+        if n_new == 0:
+            return
+
+        if self.n_samples == 0:
+            self._set_sizes(input_data, output_data)
+        self._reserve(self.n_samples + n_new)
+
+        for run_id in run_ids:
+            if run_id not in self._run_codes:
+                self._run_codes[run_id] = len(self.run_ids)
+                self.run_ids.append(run_id)
+
+        rows = slice(self.n_samples, self.n_samples + n_new)
+        self._input[rows, :] = self._to_matrix(input_data, self.inputs, self.input_sizes)
+        self._output[rows, :] = self._to_matrix(output_data, self.outputs, self.output_sizes)
+        self._run_code[rows] = [self._run_codes[run_id] for run_id in run_ids]
+        self._sample_in_run[rows] = sample_in_run
+
+        self.input_statistics.update(self._input[rows, :])
+        self.output_statistics.update(self._output[rows, :])
+
+        self.n_samples += n_new
+        self._dirty = True
+
+    def remove_runs(self, run_ids: list[str]):
+        """Remove all samples belonging to the provided runs, keeping the order of the remaining samples."""
+        codes = [self._run_codes[run_id] for run_id in run_ids if run_id in self._run_codes]
+        if not codes:
+            return
+
+        keep = ~np.isin(self.run_codes, codes)
+        self._input = np.asfortranarray(self.input_matrix[keep])
+        self._output = np.asfortranarray(self.output_matrix[keep])
+        self._run_code = np.array(self.run_codes[keep])
+        self._sample_in_run = np.array(self.sample_in_run[keep])
+        self.n_samples = int(np.count_nonzero(keep))
+        self._compute_statistics()
+        self._n_saved = 0  # Stored arrays do not match anymore, write all arrays on the next save
+        self._dirty = True
+
+    def get_statistics(self):
+        """Get the running statistics of every variable.
+
+        :return: input and output dictionaries {'variable': {'count': int, 'min': float, 'max': float, 'mean': float,
+                 'variance': float}}, with lists of the statistics of every element for vector variables
+        :rtype: [dict, dict]
+        """
+        return (self._statistics_per_variable(self.input_indices, self.input_sizes, self.input_statistics),
+                self._statistics_per_variable(self.output_indices, self.output_sizes, self.output_statistics))
+
+    def mark_dirty(self):
+        """Make sure the store is written on the next save, also when no samples are changed."""
+        self._dirty = True
+
+    def get_columns(self):
+        """Get a read-only view on the data of every variable. Vector variables are returned as 2D views (sample,
+        element). The views share memory with the store, copy them to modify the data.
+
+        :return: input and output dictionaries {'variable': np.ndarray}
+        :rtype: [dict, dict]
+        """
+        return (self._get_columns(self.input_matrix, self.input_indices, self.input_sizes),
+                self._get_columns(self.output_matrix, self.output_indices, self.output_sizes))
+
+    @property
+    def n_input_columns(self) -> int:
+        return sum(self.input_sizes.values())
+
+    @property
+    def n_output_columns(self) -> int:
+        return sum(self.output_sizes.values())
+
+    @property
+    def input_matrix(self) -> np.ndarray:
+        return self._input[:self.n_samples]
+
+    @property
+    def output_matrix(self) -> np.ndarray:
+        return self._output[:self.n_samples]
+
+    @property
+    def run_codes(self) -> np.ndarray:
+        return self._run_code[:self.n_samples]
+
+    @property
+    def sample_in_run(self) -> np.ndarray:
+        return self._sample_in_run[:self.n_samples]
+
+    def save(self):
+        """Write the samples that are added since the last save as a new segment, then update the meta file. All
+        arrays are written under a new generation instead when the stored arrays are not the ones of this store (e.g.
+        another process saved in between), samples are removed, or the segments would hold more samples than the base
+        arrays or exceed max_segments. Nothing is written when a more recent version of the store is already saved by
+        another process."""
+        if not self._dirty:
+            return
+
+        os.makedirs(self.folder, exist_ok=True)
+        stored_meta = self._read_meta(self.folder)
+        if stored_meta is not None and stored_meta.get('seq', 0) > self.seq:
+            self._dirty = False
+            return
+
+        append = (stored_meta is not None and stored_meta['generation'] == self._generation and
+                  stored_meta.get('segments', []) == self._segments and 0 < self._n_saved <= self.n_samples and
+                  self.n_samples - self._n_base <= self._n_base and
+                  len(self._segments) < self.max_segments)
+        if append and self.n_samples > self._n_saved:
+            segment = max(self._segments, default=0) + 1
+            for name, array in self._arrays(self._n_saved):
+                with open(self._array_path(name, segment=segment), 'wb') as f:
+                    np.save(f, array)
+            self._segments.append(segment)
+        elif not append:
+            # Never overwrite the files of a generation written by another process, they might be memory-mapped
+            if stored_meta is not None:
+                self._generation = max(self._generation, stored_meta['generation'])
+            self._generation += 1
+            self._segments = []
+            self._n_base = self.n_samples
+
+            for name, array in self._arrays(0):
+                with open(self._array_path(name), 'wb') as f:
+                    np.save(f, array)
+        self._n_saved = self.n_samples
+
+        meta_path = os.path.join(self.folder, self.meta_file)
+        with open(f'{meta_path}.tmp', 'w') as f:
+            json.dump(dict(generation=self._generation,
+                           seq=self.seq,
+                           n_samples=self.n_samples,
+                           n_base=self._n_base,
+                           segments=self._segments,
+                           inputs=self.inputs,
+                           outputs=self.outputs,
+                           input_sizes=self.input_sizes,
+                           output_sizes=self.output_sizes,
+                           run_ids=self.run_ids,
+                           statistics=dict(input=self.input_statistics.to_dict(),
+                                           output=self.output_statistics.to_dict())), f)
+        os.replace(f'{meta_path}.tmp', meta_path)
+
+        current_files = [os.path.basename(self._array_path(name, segment=segment)) for name in self.array_names
+                         for segment in [None] + self._segments]
+        for file in os.listdir(self.folder):
+            if file.endswith('.npy') and file not in current_files:
+                try:
+                    os.remove(os.path.join(self.folder, file))
+                except OSError:  # Still memory-mapped on Windows. Cleaned up on a later save.
+                    pass
+
+        self._dirty = False
+
+    def _compute_statistics(self):
+        self.input_statistics = RunningStatistics.from_matrix(self.input_matrix)
+        self.output_statistics = RunningStatistics.from_matrix(self.output_matrix)
+
+    @staticmethod
+    def _statistics_per_variable(indices: dict, sizes: dict, statistics: RunningStatistics) -> dict:
+        mean = np.where(statistics.count > 0, statistics.mean, np.nan)
+        columns = dict(count=statistics.count, min=statistics.min, max=statistics.max, mean=mean,
+                       variance=statistics.variance)
+
+        variable_statistics = {}
+        for variable, idx in indices.items():
+            if sizes[variable] == 1:
+                variable_statistics[variable] = {name: column[idx].item() for name, column in columns.items()}
+            else:
+                variable_statistics[variable] = {name: column[idx:idx + sizes[variable]].tolist()
+                                                 for name, column in columns.items()}
+        return variable_statistics
+
+    def _update_indices(self):
+        self.input_indices = dict(zip(self.inputs, np.cumsum([0] + list(self.input_sizes.values())[:-1]).tolist()))
+        self.output_indices = dict(zip(self.outputs, np.cumsum([0] + list(self.output_sizes.values())[:-1]).tolist()))
+
+    def _set_sizes(self, input_data: list[dict], output_data: list[dict]):
+        """Determine the amount of columns of every variable from the first samples added to the empty store."""
+        input_sizes = {variable: self._get_size(input_data, variable) for variable in self.inputs}
+        output_sizes = {variable: self._get_size(output_data, variable) for variable in self.outputs}
+        if input_sizes == self.input_sizes and output_sizes == self.output_sizes:
+            return
+
+        self.input_sizes = input_sizes
+        self.output_sizes = output_sizes
+        self._update_indices()
+        self._input = np.empty((self.initial_capacity, self.n_input_columns), order='F')
+        self._output = np.empty((self.initial_capacity, self.n_output_columns), order='F')
+        self.input_statistics = RunningStatistics(self.n_input_columns)
+        self.output_statistics = RunningStatistics(self.n_output_columns)
+
+    @staticmethod
+    def _get_size(data: list[dict], variable: str) -> int:
+        for sample in data:
+            value = sample.get(variable)
+            if value is not None:
+                return len(value) if isinstance(value, (list, tuple, np.ndarray)) else 1
+        return 1
+
+    @staticmethod
+    def _to_matrix(data: list[dict], variables: list[str], sizes: dict) -> np.ndarray:
+        """Matrix with a row per sample, in which vector variables are flattened. Missing values are NaN."""
+        n_columns = sum(sizes.values())
+        if n_columns == len(variables):
+            try:
+                return np.array([[sample.get(variable, np.nan) for variable in variables] for sample in data],
+                                dtype=float).reshape(len(data), n_columns)
+            except (TypeError, ValueError):
+                pass  # A vector where a scalar is stored, reported below
+
+        matrix = np.full((len(data), n_columns), np.nan)
+        for idx_sample, sample in enumerate(data):
+            column = 0
+            for variable in variables:
+                value = sample.get(variable)
+                if value is not None:
+                    assert np.size(value) == sizes[variable], \
+                        f'{variable} has {np.size(value)} elements, the store holds {sizes[variable]} per sample'
+                    matrix[idx_sample, column:column + sizes[variable]] = value
+                column += sizes[variable]
+        return matrix
+
+    @staticmethod
+    def _get_columns(matrix: np.ndarray, indices: dict, sizes: dict) -> dict:
+        columns = {variable: matrix[:, idx] if sizes[variable] == 1 else matrix[:, idx:idx + sizes[variable]]
+                   for variable, idx in indices.items()}
+        for column in columns.values():
+            column.setflags(write=False)  # Only the view is locked, the buffers of the store stay writable
+        return columns
+
+    @classmethod
+    def _read_meta(cls, folder: str):
+        meta_path = os.path.join(folder, cls.meta_file)
+        if not os.path.isfile(meta_path):
+            return None
+
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+
+    def _array_path(self, name: str, generation: int = None, segment: int = None) -> str:
+        if generation is None:
+            generation = self._generation
+        if segment is None:
+            return os.path.join(self.folder, f'{name}_{generation}.npy')
+        return os.path.join(self.folder, f'{name}_{generation}_{segment}.npy')
+
+    def _arrays(self, first_sample: int):
+        """Arrays to store, from first_sample on: [(name, array)]"""
+        return [('input', np.asfortranarray(self.input_matrix[first_sample:])),
+                ('output', np.asfortranarray(self.output_matrix[first_sample:])),
+                ('run_code', self.run_codes[first_sample:]),
+                ('sample_in_run', self.sample_in_run[first_sample:])]
+
+    def _load_array(self, name: str) -> np.ndarray:
+        """Memory-map the stored base array. When segments are stored, the base array and the segments are combined in
+        memory."""
+        base = np.load(self._array_path(name), mmap_mode='r')
+        if not self._segments:
+            return base
+
+        array = np.concatenate([base] + [np.load(self._array_path(name, segment=segment), mmap_mode='r')
+                                         for segment in self._segments])
+        return np.asfortranarray(array) if array.ndim == 2 else array
+
+    def _reserve(self, n_required: int):
+        """Make sure the buffers are writable and can hold n_required samples. Grows with doubling capacity."""
+        capacity = len(self._run_code)
+        if self._run_code.flags.writeable and n_required <= capacity:
+            return
+
+        new_capacity = max(self.initial_capacity, capacity)
+        while new_capacity < n_required:
+            new_capacity *= 2
+
+        n = self.n_samples
+        new_input = np.empty((new_capacity, self.n_input_columns), order='F')
+        new_input[:n] = self.input_matrix
+        new_output = np.empty((new_capacity, self.n_output_columns), order='F')
+        new_output[:n] = self.output_matrix
+        new_run_code = np.empty(new_capacity, dtype=np.int32)
+        new_run_code[:n] = self.run_codes
+        new_sample_in_run = np.empty(new_capacity, dtype=np.int64)
+        new_sample_in_run[:n] = self.sample_in_run
+
+        self._input = new_input
+        self._output = new_output
+        self._run_code = new_run_code
+        self._sample_in_run = new_sample_in_run
@@ -1,14 +1,29 @@
 import os
 import uuid
+import shutil
+import copy
+import hashlib
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import json
 
+from sas.database.columnar import ColumnStore
+from sas.database.lock import FileLock
+from sas.database.sparse import SparseEncoder
+from sas.database.archive import FileArchive
+
 
 class DB:
     """Database class that handles the storage of samples. This necessitates the storage of a tool database, and a
     database where all the executed runs are stored. This should enable the data to be tracable and should be straight-
-    forward to analyse."""
+    forward to analyse.
+
+    Multiple processes can use the same workspace. Loading and saving happen under an advisory lock on the workspace.
+    When another process saved changes since the databases were loaded, these are loaded first and the unsaved changes
+    of this process are applied on top of them, so no changes are lost."""
     timestamp_format = '%Y-%m-%d_%H-%M-%S'
+    journal_compaction_threshold = 10000  # Amount of journal records after which the journal is folded in snapshot
 
     db_location: str
     data_folder: str
@@ -16,19 +31,43 @@ class DB:
     tool_db: json
     run_db: json
 
-    def __init__(self, sas_workspace_path):
+    def __init__(self, sas_workspace_path, journal=False):
         """Either create or load database files
 
+        In journal mode, changes are appended to a JSON-lines journal instead of rewriting all the database files on
+        every save. The journal is periodically compacted into the JSON files, which act as a snapshot.
+
         :param sas_workspace_path: path to SAS workspace folder. Example C:\\Users\\USERNAME\\.sas
-        :type sas_workspace_path: str"""
+        :type sas_workspace_path: str
+        :param journal: use append-only journal for storing changes
+        :type journal: bool"""
 
         self.db_location = os.path.join(sas_workspace_path, 'storage')
         self.data_folder = os.path.join(self.db_location, 'data')
 
-        if not os.path.isdir(self.db_location) or not os.listdir(self.db_location):
+        self.journal = journal
+        self._pending_records = []
+        self._n_journal_records = 0
+
+        self._hash_index = {}  # (tool_id, sample hash) -> sample_id, for constant time duplicate detection
+        self._unique_samples = set()  # Unsaved sample_ids that must not duplicate samples saved by other processes
+        self._tool_samples = {}  # tool_id -> list of sample_ids, ordered on sequence number
+        self._last_seq = 0  # Last sequence number handed out to a sample or a change of a tool
+        self._column_stores = {}  # tool_id -> ColumnStore, loaded on first use
+        self._batch_depth = 0
+        self._batch_start = None  # Unsaved changes when the outermost batch was opened
+        self._disk_state = None  # Stat of the database files after the last load or save by this process
+
+        self._lock = FileLock(os.path.join(self.db_location, 'db.lock'))
+        with self._lock:
             self._initialize_databases()
+            self._load_databases()
 
-        self._load_databases()
+    def __getstate__(self):
+        # Column stores are a cache of the sample database and can be memory-mapped. Reload them when needed.
+        state = self.__dict__.copy()
+        state['_column_stores'] = {}
+        return state
 
     def store_run_information(self, platform, run_start_time, run_file, comments=None):
         """Add a run to the database"""
@@ -43,12 +82,14 @@ class DB:
         run['run_file'] = run_file
 
         self.run_db[run_id] = run
+        self._record('run', run_id, run)
         self._dump_databases()
         return run_id
 
     def mark_run_as_processed(self, run_id):
         """Mark run as processed"""
         self.run_db[run_id]['processed'] = True
+        self._record('run_processed', run_id)
 
     def get_run_data(self, field, run_id):
         """Get data for a certain run identified by a run_id.
@@ -78,6 +119,7 @@ class DB:
         entry['outputs'] = outputs
 
         self.tool_db[tool_id] = entry
+        self._record('tool', tool_id, entry)
         self._dump_databases()
 
         # Make new folder for tool. Here design database and other history will be stored
@@ -85,6 +127,46 @@ class DB:
 
         return tool_id
 
+    def get_tool(self, tool_id):
+        """Get the tool entry for a tool_id.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :return: tool entry, None if tool_id is unknown
+        :rtype: dict
+        """
+        return self.tool_db.get(tool_id)
+
+    def get_column_store(self, tool_id: str) -> ColumnStore:
+        """Get the columnar store of the samples of a tool. Stored arrays are memory-mapped. When the store is behind on
+        the sample database (e.g. because another process added samples), the new samples are appended from the change
+        feed. When the store is missing or can not be brought up to date, it is rebuilt from the sample database.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :return: column store of tool
+        :rtype: ColumnStore
+        """
+        tool = self.get_tool(tool_id)
+        assert tool is not None, "Invalid tool_id provided"
+        tool_seq = self.get_tool_seq(tool_id)
+
+        store = self._column_stores.get(tool_id)
+        loaded = store is None
+        folder = os.path.join(self.data_folder, tool_id, 'columns')
+        if loaded:
+            with self._lock.shared():
+                store = ColumnStore.load(folder, tool['inputs'], tool['outputs'])
+
+        if store is not None and store.seq != tool_seq:
+            store = self._update_column_store(tool_id, store) if store.seq < tool_seq else None
+
+        if store is None or (loaded and store.n_samples != self._count_samples(tool_id)):
+            store = self._build_column_store(tool_id)
+
+        self._column_stores[tool_id] = store
+        return store
+
     def get_last_sample_in_run(self, run_id, tool_name):
         current_sample = None
         for sample in self.sample_db.values():
@@ -98,46 +180,127 @@ class DB:
 
     def assert_tool(self, tool_name, kadmos_id, version, tool_info, inputs, outputs, comments=None, sur_model=False):
         """Check if tool already exists. If yes, return uuid of entry. If not, enter in database and return new uuid."""
-        for tool_id, tool in self.tool_db.items():
-            if tool['kadmos_id'] == kadmos_id and tool['version'] == version and tool['sur_model'] == sur_model:
-                print(f'{kadmos_id} using version {version} already in DB.')
-                return tool_id
-
-        return self.add_tool(tool_name=tool_name,
-                             kadmos_id=kadmos_id,
-                             version=version,
-                             tool_info=tool_info,
-                             inputs=inputs,
-                             outputs=outputs,
-                             comments=comments,
-                             sur_model=sur_model)
+        # Check against the tools saved by other processes, no other process can add the same tool in between
+        with self._lock:
+            self.reload_databases()
+            for tool_id, tool in self.tool_db.items():
+                if tool['kadmos_id'] == kadmos_id and tool['version'] == version and tool['sur_model'] == sur_model:
+                    print(f'{kadmos_id} using version {version} already in DB.')
+                    return tool_id
+
+            return self.add_tool(tool_name=tool_name,
+                                 kadmos_id=kadmos_id,
+                                 version=version,
+                                 tool_info=tool_info,
+                                 inputs=inputs,
+                                 outputs=outputs,
+                                 comments=comments,
+                                 sur_model=sur_model)
 
     def add_sample_to_tool(self, tool_id, run_id, input_data, output_data, sample_in_run, check_duplicate=True):
-        if tool_id in self.tool_db:
-            tool_name = self.tool_db[tool_id]['tool_name']
+        added_samples = self.add_samples_to_tool(tool_id=tool_id,
+                                                 run_id=run_id,
+                                                 batch=[dict(input=input_data,
+                                                             output=output_data,
+                                                             sample_in_run=sample_in_run)],
+                                                 check_duplicate=check_duplicate)
+        if added_samples:
+            return added_samples[0]
+
+    def add_samples_to_tool(self, tool_id, run_id, batch: list[dict], check_duplicate=True):
+        """Add multiple samples of a single run to a tool at once. Duplicate detection and the update of the indices
+        are executed once for the complete batch.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :param run_id: uuid of run in database
+        :type run_id: str
+        :param batch: samples in format [{'input': {'inVariable1': float, ...},
+                                          'output': {'outVariable1': float, ...},
+                                          'sample_in_run': int}, ...]
+        :param check_duplicate: skip samples that are identical to a sample already in the database
+        :return: list of added samples
+        :rtype: list[dict]
+        """
+        tool = self.get_tool(tool_id)
+        if tool is not None:
+            tool_name = tool['tool_name']
         else:
             tool_name = ''
 
-        sample = dict()
-        sample_id = str(uuid.uuid4())
-        sample['tool_id'] = tool_id
-        sample['tool_name'] = tool_name
-        sample['run_id'] = run_id
-        sample['input'] = input_data
-        sample['output'] = output_data
-        sample['sample_in_run'] = sample_in_run
-        sample['hash'] = hash(str(input_data | output_data))  # Use to quickly check uniqueness of sample
+        samples = []
+        for batch_sample in batch:
+            sample = dict()
+            sample['tool_id'] = tool_id
+            sample['tool_name'] = tool_name
+            sample['run_id'] = run_id
+            sample['input'] = batch_sample['input']
+            sample['output'] = batch_sample['output']
+            sample['sample_in_run'] = batch_sample['sample_in_run']
+            # Use to quickly check uniqueness of sample
+            sample['hash'] = self.get_sample_hash(batch_sample['input'], batch_sample['output'])
+            samples.append(sample)
 
         if check_duplicate:
-            for existing_sample in self.sample_db.values():
-                if sample['hash'] == existing_sample['hash']:
-                    print(f"Identical sample for {tool_name} is already in database. Sample skipped")
-                    return
-
-        self.sample_db[sample_id] = sample
-        return sample
-
-    def get_all_samples(self, tool_id: str, batched=False):
+            known_hashes = self._find_existing_hashes(tool_id, [sample['hash'] for sample in samples])
+            unique_samples = []
+            for sample in samples:
+                if sample['hash'] in known_hashes:
+                    continue
+                known_hashes.add(sample['hash'])
+                unique_samples.append(sample)
+
+            n_skipped = len(samples) - len(unique_samples)
+            if n_skipped == 1:
+                print(f"Identical sample for {tool_name} is already in database. Sample skipped")
+            elif n_skipped > 1:
+                print(f"{n_skipped} identical samples for {tool_name} are already in database. Samples skipped")
+            samples = unique_samples
+
+        if not samples:
+            return []
+
+        store = self.get_column_store(tool_id) if tool is not None else None
+
+        self._store_samples([(str(uuid.uuid4()), sample) for sample in samples], unique=check_duplicate)
+
+        if store is not None:
+            store.extend(run_ids=[run_id] * len(samples),
+                         sample_in_run=[sample['sample_in_run'] for sample in samples],
+                         input_data=[sample['input'] for sample in samples],
+                         output_data=[sample['output'] for sample in samples])
+            store.seq = self.get_tool_seq(tool_id)
+        return samples
+
+    @contextmanager
+    def batch(self):
+        """Context in which all changes to the database are persisted once, when the context is closed. Can be nested.
+
+        Example:
+            with db.batch():
+                for tool_id, batch in batches.items():
+                    db.add_samples_to_tool(tool_id, run_id, batch)
+                db.mark_run_as_processed(run_id)
+
+        When the context is closed by an exception, all changes made within it are discarded. Changes made before the
+        batch was opened are kept.
+        """
+        if self._batch_depth == 0:
+            self._begin_batch()
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._discard_batch()
+            raise
+
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.save_databases()
+
+    def get_all_samples(self, tool_id: str, batched=False, as_array=False):
         """ Get all the samples from the database for a certain tool_id.
 
         Extracts the data and puts it in list/array format, grouped for input and output and variable. Structure:
@@ -148,12 +311,19 @@ class DB:
         data = [runId][sample_in_run]{'input': {'inVariableN': float, ...}
                                       'output': {'outVariableN': float, ...}}
 
+        If 'as_array' is activated, the lists are replaced by read-only numpy views on the columnar store of the tool.
+
         :param tool_id: uuid of tool in database
         :type tool_id: str
         :param batched: Switch to 'batch' data per run and sample number, changes output dict
+        :param as_array: Return numpy arrays from the columnar store instead of lists
         :return: input and output dictionaries containing all samples for specified tool
         :rtype: [dict, dict]
         """
+        if as_array:
+            assert not batched, "Batched samples can not be returned as array"
+            return self.get_column_store(tool_id).get_columns()
+
         inputs = dict()
         outputs = dict()
 
@@ -201,23 +371,269 @@ class DB:
             return inputs, outputs
 
     def delete_runs(self, run_ids):
-        [self.delete_run(run_id) for run_id in run_ids]
+        """Delete multiple runs and their samples at once. The samples are scanned once and the changes are persisted
+        once for all runs.
 
-    def delete_run(self, run_id):
-        self.run_db.pop(run_id)
+        :param run_ids: uuids of runs in database
+        :type run_ids: list[str]
+        """
+        run_ids = list(dict.fromkeys(run_ids))
+        for run_id in run_ids:
+            self.run_db.pop(run_id)
 
+        deleted_runs = set(run_ids)
         samples_to_pop = []
+        tools_in_runs = set()
         for key, sample in self.sample_db.items():
-            if sample['run_id'] == run_id:
+            if sample['run_id'] in deleted_runs:
                 samples_to_pop.append(key)
+                tools_in_runs.add(sample['tool_id'])
+
+        stores = {tool_id: self.get_column_store(tool_id) for tool_id in tools_in_runs if tool_id in self.tool_db}
+        for store in stores.values():
+            store.remove_runs(run_ids)
 
         for key in samples_to_pop:
             self.sample_db.pop(key)
+        self._build_indices()
+
+        self._record('delete_runs', None, run_ids)
+
+        # Consumers that synchronized before this point can not rely on the change feed anymore for these tools
+        self._last_seq += 1
+        for tool_id, store in stores.items():
+            self.tool_db[tool_id]['seq'] = self._last_seq
+            self.tool_db[tool_id]['reset_seq'] = self._last_seq
+            self._record('tool', tool_id, self.tool_db[tool_id])
+            store.seq = self._last_seq
 
         self.save_databases()
 
+    def delete_run(self, run_id):
+        self.delete_runs([run_id])
+
+    def compact(self):
+        """Remove data that is not referenced anymore and rebuild the indices and the column stores. Removes the
+        data folders (storage/data/<tool_id>/<run_id>) and the archived files of runs that are deleted from the
+        database.
+
+        :return: removed data folders
+        :rtype: list[str]
+        """
+        assert self._batch_depth == 0, "Database can not be compacted within a batch"
+
+        time_started = time.time()
+        with self._lock:
+            self.reload_databases()
+
+            run_ids = self._get_run_ids()
+            removed_folders = []
+            for tool_id in os.listdir(self.data_folder):
+                tool_folder = os.path.join(self.data_folder, tool_id)
+                if not os.path.isdir(tool_folder):
+                    continue
+
+                for folder in os.listdir(tool_folder):
+                    run_folder = os.path.join(tool_folder, folder)
+                    if folder != 'columns' and folder not in run_ids and os.path.isdir(run_folder):
+                        shutil.rmtree(run_folder)
+                        removed_folders.append(run_folder)
+
+            archive = FileArchive(self.archive_folder)
+            for tool_id, run_id in archive.list_runs():
+                if run_id not in run_ids:
+                    archive.remove_run(tool_id, run_id)
+            archive.collect_garbage(modified_before=time_started)  # Runs are archived without the workspace lock
+
+            self._compact_databases()
+
+            self._column_stores = {tool_id: self._build_column_store(tool_id) for tool_id in self._get_tool_ids()}
+            self._save_column_stores()
+
+        print(f'Removed {len(removed_folders)} orphaned data folders from {self.data_folder}')
+        return removed_folders
+
+    def get_tool_seq(self, tool_id: str) -> int:
+        """Get the version of a tool: the sequence number of the last change to its samples. Increases monotonically.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :rtype: int
+        """
+        tool = self.get_tool(tool_id)
+        assert tool is not None, "Invalid tool_id provided"
+        return tool.get('seq', 0)
+
+    def get_samples_since(self, tool_id: str, seq: int):
+        """Change feed of the samples of a tool. Get all samples that are added after sequence number seq.
+
+        If samples of the tool are deleted after seq, the feed can not be applied on top of the state of the consumer.
+        In that case all samples of the tool are returned and full is True: the consumer should replace its data.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :param seq: sequence number of last synchronization. 0 to get all samples
+        :type seq: int
+        :return: samples (ordered on their 'seq'), current version of the tool, full
+        :rtype: [list[dict], int, bool]
+        """
+        tool = self.get_tool(tool_id)
+        assert tool is not None, "Invalid tool_id provided"
+
+        full = tool.get('reset_seq', 0) > seq
+        if full:
+            seq = 0
+
+        # Sample lists are ordered on sequence number: walk back from the end until the last synchronized sample
+        sample_ids = self._tool_samples.get(tool_id, [])
+        first_new = len(sample_ids)
+        while first_new > 0 and self.sample_db[sample_ids[first_new - 1]]['seq'] > seq:
+            first_new -= 1
+        samples = [self.sample_db[sample_id] for sample_id in sample_ids[first_new:]]
+
+        return samples, tool.get('seq', 0), full
+
     def save_databases(self):
-        self._dump_databases()
+        if self._batch_depth > 0:  # Persisted when the batch is closed
+            return
+
+        with self._lock:
+            self._dump_databases()
+            self._save_column_stores()
+
+    def reload_databases(self):
+        """Load the changes that other processes saved since the databases were loaded by this process. Changes of
+        this process that are not saved yet are kept."""
+        with self._lock:
+            if self._get_disk_state() != self._disk_state:
+                self._merge_from_disk()
+
+    @staticmethod
+    def get_sample_hash(input_data: dict, output_data: dict) -> str:
+        """Deterministic content hash of a sample. Values are canonicalized to floats and sorted on variable name, so
+        the hash is identical across sessions and independent of the order in which the variables are provided.
+
+        :param input_data: input values of sample {'inVariable1': float, ...}
+        :param output_data: output values of sample {'outVariable1': float, ...}
+        :return: hexadecimal blake2b digest
+        :rtype: str
+        """
+        def canonicalize(data):
+            return sorted((variable, float(value) if isinstance(value, (int, float)) else value)
+                          for variable, value in data.items())
+
+        content = json.dumps([canonicalize(input_data), canonicalize(output_data)], separators=(',', ':'))
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+    def compact_journal(self):
+        """Fold the journal into the snapshot (the JSON database files) and start with an empty journal."""
+        with self._lock:
+            if self._get_disk_state() != self._disk_state:
+                self._merge_from_disk()
+
+            self._pending_records = []
+            self._unique_samples = set()
+            self._write_snapshot()
+
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+            self._n_journal_records = 0
+            self._disk_state = self._get_disk_state()
+
+    def _find_existing_hashes(self, tool_id, hashes: list[str]) -> set:
+        """Find which of the provided sample hashes are already stored for a tool. Only the samples known to this
+        process are checked; samples that another process saved in the meantime are skipped when the changes are
+        merged (see _merge_from_disk)."""
+        return {sample_hash for sample_hash in hashes if (tool_id, sample_hash) in self._hash_index}
+
+    def _store_samples(self, samples: list[tuple[str, dict]], unique: bool = False):
+        """Store samples, unique if they are checked for duplicates."""
+        if unique:
+            self._unique_samples.update(sample_id for sample_id, _ in samples)
+
+        for sample_id, sample in samples:
+            self._last_seq += 1
+            sample['seq'] = self._last_seq
+            self.sample_db[sample_id] = sample
+            self._index_sample(sample_id, sample)
+            self._record('sample', sample_id, sample)
+
+    def _begin_batch(self):
+        """Called when the outermost batch is opened. Keeps a copy of the unsaved changes, the databases are changed in
+        place by the batch."""
+        self._batch_start = (copy.deepcopy(self._pending_records), set(self._unique_samples), self._last_seq,
+                             self._disk_state)
+
+    def _discard_batch(self):
+        """Called when a batch is closed by an exception. The databases are reloaded from disk and the changes that were
+        not saved when the batch was opened are applied again, so no change of the batch is kept. If another process
+        saved in the meantime, the changes are merged with its changes instead (see _merge_from_disk)."""
+        self._pending_records, self._unique_samples, last_seq, disk_state = self._batch_start
+        self._batch_start = None
+        with self._lock:
+            if self._get_disk_state() != disk_state:
+                self._merge_from_disk()
+                return
+
+            self._last_seq = last_seq
+            self._load_databases()
+            for record in self._pending_records:
+                self._apply_record(record)
+            self._build_indices()
+            self._column_stores = {}
+
+    def _build_column_store(self, tool_id) -> ColumnStore:
+        """Build the column store of a tool from the sample database."""
+        tool = self.get_tool(tool_id)
+        tool_seq = self.get_tool_seq(tool_id)
+
+        store = ColumnStore(os.path.join(self.data_folder, tool_id, 'columns'), tool['inputs'], tool['outputs'])
+        samples = list(self._iter_samples(tool_id))
+        store.extend(run_ids=[sample['run_id'] for sample in samples],
+                     sample_in_run=[sample['sample_in_run'] for sample in samples],
+                     input_data=[sample['input'] for sample in samples],
+                     output_data=[sample['output'] for sample in samples])
+        store.seq = max([tool_seq] + [sample['seq'] for sample in samples])
+        store.mark_dirty()
+        return store
+
+    def _update_column_store(self, tool_id, store: ColumnStore):
+        """Append the samples that are added to the sample database after the version of the store.
+
+        :return: updated store, None if samples are deleted since and the store has to be rebuilt
+        :rtype: ColumnStore
+        """
+        samples, tool_seq, full = self.get_samples_since(tool_id, store.seq)
+        if full:
+            return None
+
+        store.extend(run_ids=[sample['run_id'] for sample in samples],
+                     sample_in_run=[sample['sample_in_run'] for sample in samples],
+                     input_data=[sample['input'] for sample in samples],
+                     output_data=[sample['output'] for sample in samples])
+        store.seq = max([tool_seq] + [sample['seq'] for sample in samples])
+        return store
+
+    def _save_column_stores(self):
+        for store in self._column_stores.values():
+            store.save()
+
+    def _compact_databases(self):
+        self._build_indices()
+        self.compact_journal()
+
+    def _get_tool_ids(self):
+        return list(self.tool_db)
+
+    def _get_run_ids(self):
+        return set(self.run_db)
+
+    def _count_samples(self, tool_id):
+        return len(self._tool_samples.get(tool_id, []))
+
+    def _iter_samples(self, tool_id):
+        """Iterate over all the samples of a tool, in order of insertion."""
+        return (self.sample_db[sample_id] for sample_id in self._tool_samples.get(tool_id, []))
 
     @property
     def tool_db_path(self):
@@ -234,19 +650,22 @@ class DB:
         sample_db_file = 'sample_db.json'
         return os.path.join(self.db_location, sample_db_file)
 
-    def _initialize_databases(self):
-        if not os.path.isdir(self.db_location):
-            os.mkdir(self.db_location)
-            os.mkdir(self.data_folder)
+    @property
+    def archive_folder(self):
+        return os.path.join(self.db_location, 'archive')
 
-        with open(self.tool_db_path, 'w') as f:
-            f.write('{}')
+    @property
+    def journal_path(self):
+        journal_file = 'journal.jsonl'
+        return os.path.join(self.db_location, journal_file)
 
-        with open(self.run_db_path, 'w') as f:
-            f.write('{}')
+    def _initialize_databases(self):
+        os.makedirs(self.data_folder, exist_ok=True)
 
-        with open(self.sample_db_path, 'w') as f:
-            f.write('{}')
+        for path in [self.tool_db_path, self.run_db_path, self.sample_db_path]:
+            if not os.path.isfile(path):
+                with open(path, 'w') as f:
+                    f.write('{}')
 
     def _load_databases(self):
         with open(self.tool_db_path, 'r') as f:
@@ -257,16 +676,190 @@ class DB:
 
         with open(self.sample_db_path, 'r') as f:
             self.sample_db = json.load(f)
+        if self.sample_db.get('format') == 'sparse':
+            self.sample_db = SparseEncoder.decode_samples(self.sample_db)
+
+        # Changes since the last snapshot are stored in the journal. Also replayed when journal mode is not active.
+        self._n_journal_records = 0
+        if os.path.isfile(self.journal_path):
+            self._replay_journal()
+
+        self._build_indices()
+        self._disk_state = self._get_disk_state()
+
+    def _get_disk_state(self):
+        """Stat of the database files, used to detect changes by other processes."""
+        disk_state = []
+        for path in [self.tool_db_path, self.run_db_path, self.sample_db_path, self.journal_path]:
+            try:
+                stat = os.stat(path)
+                disk_state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                disk_state.append(None)
+        return disk_state
+
+    def _merge_from_disk(self):
+        """Load the databases saved by another process and apply the unsaved changes of this process on top. Samples
+        and resets of this process get new sequence numbers after the ones saved by the other process. Unique samples
+        that the other process saved as well are skipped."""
+        pending_records = self._pending_records
+        self._load_databases()
 
-    def _dump_databases(self):
-        with open(self.tool_db_path, 'w') as f:
-            json.dump(self.tool_db, f, indent=4)
+        merged_records = []
+        for record in pending_records:
+            if record['op'] == 'sample' and record['id'] in self._unique_samples:
+                sample = record['data']
+                if (sample['tool_id'], sample['hash']) in self._hash_index:
+                    continue
+                self._hash_index[(sample['tool_id'], sample['hash'])] = record['id']
+            merged_records.append(record)
+
+            if record['op'] == 'sample':
+                self._last_seq += 1
+                record['data']['seq'] = self._last_seq
+            elif record['op'] == 'tool' and record['id'] in self.tool_db:
+                stored_tool = self.tool_db[record['id']]
+                if record['data'].get('reset_seq', 0) != stored_tool.get('reset_seq', 0):
+                    self._last_seq += 1
+                    record['data']['reset_seq'] = self._last_seq
+                record['data']['seq'] = max(record['data'].get('seq', 0), stored_tool.get('seq', 0),
+                                            record['data'].get('reset_seq', 0))
+            self._apply_record(record)
+
+        self._pending_records = merged_records
+        self._build_indices()
+        n_duplicates = len(pending_records) - len(merged_records)
+        if n_duplicates > 0:
+            print(f'{n_duplicates} samples are saved by another process in the meantime. Samples skipped')
+        # Stores of this process miss the samples of the other process and use outdated sequence numbers
+        self._column_stores = {}
+
+    def _build_indices(self):
+        """(Re)build the hash index, the sample lists per tool and the sequence numbers. Samples stored with the
+        process-salted hash of older versions are rehashed, samples without sequence number get one in order of
+        insertion."""
+        self._last_seq = max([sample.get('seq', 0) for sample in self.sample_db.values()] +
+                             [tool.get('seq', 0) for tool in self.tool_db.values()] + [self._last_seq])
+
+        self._hash_index = {}
+        self._tool_samples = {}
+        for sample_id, sample in self.sample_db.items():
+            if not isinstance(sample['hash'], str):
+                sample['hash'] = self.get_sample_hash(sample['input'], sample['output'])
+            if 'seq' not in sample:
+                self._last_seq += 1
+                sample['seq'] = self._last_seq
+            self._index_sample(sample_id, sample)
+
+    def _index_sample(self, sample_id, sample):
+        self._hash_index.setdefault((sample['tool_id'], sample['hash']), sample_id)
+        self._tool_samples.setdefault(sample['tool_id'], []).append(sample_id)
+
+        tool = self.tool_db.get(sample['tool_id'])
+        if tool is not None and tool.get('seq', 0) < sample['seq']:
+            tool['seq'] = sample['seq']
+
+    def _replay_journal(self):
+        """Apply all records in the journal to the databases loaded from the snapshot. If the process crashed while
+        writing to the journal, the last line might be incomplete. This torn record is discarded and cut from the file.
+        """
+        with open(self.journal_path, 'rb') as f:
+            lines = f.readlines()
+
+        valid_size = 0
+        self._n_journal_records = 0
+        for idx_line, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if idx_line == len(lines) - 1:
+                    print(f'Incomplete last record found in {self.journal_path}. Record is discarded.')
+                    with open(self.journal_path, 'r+b') as f:
+                        f.truncate(valid_size)
+                    break
+                else:
+                    raise AssertionError(f'Journal {self.journal_path} is corrupted at line {idx_line + 1}')
+
+            if not line.endswith(b'\n'):  # Torn record that happens to be valid JSON: complete it
+                with open(self.journal_path, 'ab') as f:
+                    f.write(b'\n')
+
+            self._apply_record(record)
+            valid_size += len(line)
+            self._n_journal_records += 1
+
+    def _apply_record(self, record):
+        op = record['op']
+        if op == 'tool':
+            self.tool_db[record['id']] = record['data']
+        elif op == 'run':
+            self.run_db[record['id']] = record['data']
+        elif op == 'run_processed':
+            if record['id'] in self.run_db:
+                self.run_db[record['id']]['processed'] = True
+        elif op == 'sample':
+            self.sample_db[record['id']] = record['data']
+        elif op in ['delete_run', 'delete_runs']:
+            run_ids = set(record['data']) if op == 'delete_runs' else {record['id']}
+            for run_id in run_ids:
+                self.run_db.pop(run_id, None)
+            for key in [key for key, sample in self.sample_db.items() if sample['run_id'] in run_ids]:
+                self.sample_db.pop(key)
+        else:
+            raise AssertionError(f'Unknown operation {op} in journal')
 
-        with open(self.run_db_path, 'w') as f:
-            json.dump(self.run_db, f, indent=4)
+    def _record(self, op, id, data=None):
+        """Register a change to the databases, to be saved on the next save. In journal mode it is appended to the
+        journal, otherwise the records are only used to merge with changes of other processes."""
+        record = dict(op=op, id=id)
+        if data is not None:
+            record['data'] = data
+        self._pending_records.append(record)
 
-        with open(self.sample_db_path, 'w') as f:
-            json.dump(self.sample_db, f, indent=4)
+    def _dump_databases(self):
+        if self._batch_depth > 0:  # Persisted when the batch is closed
+            return
+
+        with self._lock:
+            if self._get_disk_state() != self._disk_state:
+                self._merge_from_disk()
+
+            if not self.journal:
+                self._write_snapshot()
+                self._pending_records = []
+                self._unique_samples = set()
+
+                # A journal left behind by a session in journal mode is now fully contained in the snapshot
+                if os.path.isfile(self.journal_path):
+                    os.remove(self.journal_path)
+            elif self._pending_records:
+                with open(self.journal_path, 'a') as f:
+                    for record in self._pending_records:
+                        f.write(json.dumps(record) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self._n_journal_records += len(self._pending_records)
+                self._pending_records = []
+                self._unique_samples = set()
+
+            self._disk_state = self._get_disk_state()
+
+            if self.journal and self._n_journal_records >= self.journal_compaction_threshold:
+                self.compact_journal()
+
+    def _write_snapshot(self):
+        # Write to temporary files first, so a crash never leaves a half-written snapshot behind
+        for path, database in [(self.tool_db_path, self.tool_db),
+                               (self.run_db_path, self.run_db)]:
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(database, f, indent=4)
+            os.replace(f'{path}.tmp', path)
+
+        # Samples are stored in sparse format without indentation, it is by far the largest file
+        with open(f'{self.sample_db_path}.tmp', 'w') as f:
+            json.dump(SparseEncoder().encode_samples(self.sample_db), f, separators=(',', ':'))
+        os.replace(f'{self.sample_db_path}.tmp', self.sample_db_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """Advisory inter-process lock on a lock file. Uses flock on POSIX systems and msvcrt on Windows.
+
+    Shared locks allow multiple readers at once. Windows does not support shared locks, there every lock is exclusive.
+    Within a process the lock is reentrant, also across FileLock objects for the same file: nested acquisitions are
+    counted and only the outermost release unlocks the file. A shared lock can not be upgraded to an exclusive lock."""
+    _held = {}  # Absolute lock file path -> [open file, depth, shared], shared by all FileLocks in this process
+
+    def __init__(self, path: str, timeout: float = 300., poll_interval: float = 0.05):
+        """
+        :param path: path of lock file, created when it does not exist
+        :param timeout: maximum time in seconds to wait for the lock, after which a TimeoutError is raised
+        :param poll_interval: time in seconds between attempts to acquire the lock
+        """
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def acquire(self, shared: bool = False):
+        if self.path in self._held:
+            held = self._held[self.path]
+            assert shared or not held[2], "Shared lock can not be upgraded to an exclusive lock"
+            held[1] += 1
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, 'a+b')
+        time_started = time.time()
+        while True:
+            try:
+                self._lock_file(lock_file, shared)
+                break
+            except OSError:
+                if time.time() - time_started > self.timeout:
+                    lock_file.close()
+                    raise TimeoutError(f'Could not acquire lock on {self.path} within {self.timeout}s')
+                time.sleep(self.poll_interval)
+
+        self._held[self.path] = [lock_file, 1, shared]
+
+    def release(self):
+        assert self.path in self._held, "Lock is not acquired"
+        held = self._held[self.path]
+        held[1] -= 1
+        if held[1] > 0:
+            return
+
+        lock_file = held[0]
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+        lock_file.close()
+        del self._held[self.path]
+
+    def shared(self):
+        """Use as context manager for a shared (read) lock. Example:
+            with lock.shared():
+                ...
+        """
+        return _SharedLock(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    @staticmethod
+    def _lock_file(lock_file, shared: bool):
+        if fcntl is not None:
+            fcntl.flock(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+class _SharedLock:
+    def __init__(self, lock: FileLock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire(shared=True)
+        return self.lock
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
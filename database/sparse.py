@@ -0,0 +1,119 @@
+class SparseEncoder:
+    """Compact representation of the input and output data of samples.
+
+    Variable names are interned to integer ids per tool. Every run of a tool gets a template: the input and output
+    values of its first sample. Samples only store the values that differ from the template of their run, which for
+    most disciplines are a handful of design variables among many constants from the initial CPACS file.
+
+    Encoded data is either a dict {'variable id': value} with the differences with the template, or a list of
+    [variable id, value] pairs with all values, used when the variables of a sample do not match the template."""
+    def __init__(self):
+        self.variables = {}  # tool_id -> list of variable names, the index is the variable id
+        self.variable_ids = {}  # tool_id -> {variable name: variable id}
+        self.templates = {}  # (tool_id, run_id) -> (input template, output template), both {variable name: value}
+
+    def intern(self, tool_id: str, name: str) -> int:
+        """Get the id of a variable of a tool, a new id is assigned to unknown variables."""
+        variable_ids = self.variable_ids.setdefault(tool_id, {})
+        if name not in variable_ids:
+            variables = self.variables.setdefault(tool_id, [])
+            variable_ids[name] = len(variables)
+            variables.append(name)
+        return variable_ids[name]
+
+    def set_template(self, tool_id: str, run_id: str, input_data: dict, output_data: dict):
+        self.templates[(tool_id, run_id)] = (dict(input_data), dict(output_data))
+
+    def encode(self, tool_id: str, run_id: str, input_data: dict, output_data: dict):
+        """Encode the input and output data of a sample. The first sample of a run becomes the template of the run.
+
+        :return: encoded input and output data
+        :rtype: [dict | list, dict | list]
+        """
+        if (tool_id, run_id) not in self.templates:
+            self.set_template(tool_id, run_id, input_data, output_data)
+
+        input_template, output_template = self.templates[(tool_id, run_id)]
+        return self._encode(tool_id, input_data, input_template), self._encode(tool_id, output_data, output_template)
+
+    def decode(self, tool_id: str, run_id: str, encoded_input, encoded_output):
+        """Decode the input and output data of a sample into dicts {'variable': value}.
+
+        :rtype: [dict, dict]
+        """
+        input_template, output_template = self.templates[(tool_id, run_id)]
+        return self._decode(tool_id, encoded_input, input_template), self._decode(tool_id, encoded_output,
+                                                                                  output_template)
+
+    def encode_template(self, tool_id: str, run_id: str):
+        """Encode the template of a run, as lists of [variable id, value] pairs.
+
+        :rtype: [list, list]
+        """
+        input_template, output_template = self.templates[(tool_id, run_id)]
+        return ([[self.intern(tool_id, name), value] for name, value in input_template.items()],
+                [[self.intern(tool_id, name), value] for name, value in output_template.items()])
+
+    def decode_template(self, tool_id: str, run_id: str, encoded_input: list, encoded_output: list):
+        """Set the template of a run from lists of [variable id, value] pairs."""
+        self.set_template(tool_id, run_id,
+                          self._decode(tool_id, encoded_input, None),
+                          self._decode(tool_id, encoded_output, None))
+
+    def encode_samples(self, sample_db: dict) -> dict:
+        """Encode a complete sample database {sample_id: sample}, including the variable names and templates.
+
+        :return: sparse sample database, which can be stored as JSON
+        :rtype: dict
+        """
+        samples = {}
+        for sample_id, sample in sample_db.items():
+            encoded_sample = dict(sample)
+            encoded_sample['input'], encoded_sample['output'] = self.encode(sample['tool_id'], sample['run_id'],
+                                                                            sample['input'], sample['output'])
+            samples[sample_id] = encoded_sample
+
+        templates = {}
+        for tool_id, run_id in self.templates:
+            templates.setdefault(tool_id, {})[run_id] = self.encode_template(tool_id, run_id)
+
+        return dict(format='sparse', variables=self.variables, templates=templates, samples=samples)
+
+    @classmethod
+    def decode_samples(cls, sparse_db: dict) -> dict:
+        """Decode a sparse sample database created by encode_samples.
+
+        :return: sample database {sample_id: sample}
+        :rtype: dict
+        """
+        encoder = cls()
+        for tool_id, variables in sparse_db['variables'].items():
+            for name in variables:
+                encoder.intern(tool_id, name)
+
+        for tool_id, templates in sparse_db['templates'].items():
+            for run_id, (encoded_input, encoded_output) in templates.items():
+                encoder.decode_template(tool_id, run_id, encoded_input, encoded_output)
+
+        sample_db = sparse_db['samples']
+        for sample in sample_db.values():
+            sample['input'], sample['output'] = encoder.decode(sample['tool_id'], sample['run_id'],
+                                                               sample['input'], sample['output'])
+        return sample_db
+
+    def _encode(self, tool_id: str, data: dict, template: dict):
+        if list(data) != list(template):
+            return [[self.intern(tool_id, name), value] for name, value in data.items()]
+
+        # The type is compared as well, so an int is never decoded as the float of the template or vice versa
+        return {str(self.intern(tool_id, name)): value for name, value in data.items()
+                if not (value == template[name] and type(value) is type(template[name]))}
+
+    def _decode(self, tool_id: str, encoded_data, template: dict):
+        variables = self.variables.get(tool_id, [])
+        if isinstance(encoded_data, list):
+            return {variables[variable_id]: value for variable_id, value in encoded_data}
+
+        data = template.copy()
+        data.update({variables[int(variable_id)]: value for variable_id, value in encoded_data.items()})
+        return data
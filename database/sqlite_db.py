@@ -0,0 +1,580 @@
+import os
+import uuid
+import json
+import sqlite3
+from datetime import datetime
+
+from sas.database.db import DB
+from sas.database.sparse import SparseEncoder
+
+
+class SQLiteDB(DB):
+    """SQLite storage engine for the sample database. Exposes the same API as the JSON based DB class, but stores the
+    tools, runs and samples in a single SQLite file. All sample queries are executed on indexed columns, which prevents
+    full scans over all the samples in the database for every request.
+
+    An existing JSON workspace (tool_db.json, run_db.json and sample_db.json) is migrated automatically when the SQLite
+    file does not exist yet.
+
+    Input and output data of samples are stored in the sparse format of SparseEncoder: variable names are interned in
+    the variables table and the values of the first sample of every run are stored once in the run_templates table.
+
+    The database runs in WAL mode, so readers in other processes see a consistent snapshot while a process writes.
+    Writes are executed in a transaction that takes the write lock up front (BEGIN IMMEDIATE) and is committed on save
+    or when the batch is closed. Other writers wait for the lock for at most busy_timeout seconds."""
+    sqlite_db_file = 'sas_db.sqlite'
+    busy_timeout = 300.
+
+    def __init__(self, sas_workspace_path):
+        """Either create or load the SQLite database file
+
+        :param sas_workspace_path: path to SAS workspace folder. Example C:\\Users\\USERNAME\\.sas
+        :type sas_workspace_path: str"""
+        self._connection = None
+        self._sparse_encoder = SparseEncoder()  # Cache of the variables and run_templates tables
+        super(SQLiteDB, self).__init__(sas_workspace_path)
+
+    def __getstate__(self):
+        # Connections can not be pickled (surrogate models keep a reference to their DB). Reconnect lazily.
+        state = super(SQLiteDB, self).__getstate__()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # Transactions are managed explicitly, see _begin
+            self._connection = sqlite3.connect(self.sqlite_db_path, timeout=self.busy_timeout, isolation_level=None)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute('PRAGMA journal_mode=WAL')
+        return self._connection
+
+    @property
+    def sqlite_db_path(self):
+        return os.path.join(self.db_location, self.sqlite_db_file)
+
+    def store_run_information(self, platform, run_start_time, run_file, comments=None):
+        """Add a run to the database"""
+        run_id = str(uuid.uuid4())
+        self._begin()
+        self.connection.execute('INSERT INTO runs (run_id, timestamp, run_start_time, platform, comments, processed, '
+                                'run_file) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (run_id,
+                                 datetime.strftime(datetime.now(), self.timestamp_format),
+                                 datetime.strftime(run_start_time, self.timestamp_format),
+                                 platform,
+                                 comments,
+                                 False,
+                                 run_file))
+        self._dump_databases()
+        return run_id
+
+    def mark_run_as_processed(self, run_id):
+        """Mark run as processed"""
+        self._begin()
+        self.connection.execute('UPDATE runs SET processed = 1 WHERE run_id = ?', (run_id,))
+
+    def get_run_data(self, field, run_id):
+        """Get data for a certain run identified by a run_id.
+
+        :param field: data of interest (e.g. 'run_start_time')
+        :type field: str
+        :param run_id: run_id of run of interest
+        :type run_id: str
+        """
+        run = self.connection.execute('SELECT * FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        if run is None:
+            return None
+
+        if field == 'processed':
+            return bool(run[field])
+        return run[field]
+
+    def add_tool(self, tool_name, kadmos_id, version, tool_info, inputs, outputs, comments=None, sur_model=False):
+        """Add a new tool to the database"""
+        tool_id = str(uuid.uuid4())
+        self._begin()
+        self._insert_tool(tool_id, dict(sur_model=sur_model,
+                                        tool_name=tool_name,
+                                        kadmos_id=kadmos_id,
+                                        version=version,
+                                        tool_info=tool_info,
+                                        comments=comments,
+                                        inputs=inputs,
+                                        outputs=outputs))
+        self._dump_databases()
+
+        # Make new folder for tool. Here design database and other history will be stored
+        os.makedirs(os.path.join(self.data_folder, tool_id), exist_ok=True)
+
+        return tool_id
+
+    def get_tool(self, tool_id):
+        """Get the tool entry for a tool_id, in the same format as the entries of the JSON tool database.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :return: tool entry, None if tool_id is unknown
+        :rtype: dict
+        """
+        tool = self.connection.execute('SELECT * FROM tools WHERE tool_id = ?', (tool_id,)).fetchone()
+        if tool is None:
+            return None
+
+        return dict(sur_model=bool(tool['sur_model']),
+                    tool_name=tool['tool_name'],
+                    kadmos_id=tool['kadmos_id'],
+                    version=tool['version'],
+                    tool_info=json.loads(tool['tool_info']),
+                    comments=json.loads(tool['comments']),
+                    inputs=json.loads(tool['inputs']),
+                    outputs=json.loads(tool['outputs']))
+
+    def get_last_sample_in_run(self, run_id, tool_name):
+        sample = self.connection.execute('SELECT * FROM samples WHERE run_id = ? AND tool_name = ? '
+                                         'ORDER BY sample_in_run DESC, seq ASC LIMIT 1',
+                                         (run_id, tool_name)).fetchone()
+        if sample is None:
+            return None
+
+        return self._row_to_sample(sample)
+
+    def assert_tool(self, tool_name, kadmos_id, version, tool_info, inputs, outputs, comments=None, sur_model=False):
+        """Check if tool already exists. If yes, return uuid of entry. If not, enter in database and return new uuid."""
+        self._begin()  # Prevents that another process adds the same tool in between
+        tool = self.connection.execute('SELECT tool_id FROM tools WHERE kadmos_id = ? AND version = ? AND sur_model = ? '
+                                       'ORDER BY rowid LIMIT 1',
+                                       (kadmos_id, version, sur_model)).fetchone()
+        if tool is not None:
+            print(f'{kadmos_id} using version {version} already in DB.')
+            self._dump_databases()
+            return tool['tool_id']
+
+        return self.add_tool(tool_name=tool_name,
+                             kadmos_id=kadmos_id,
+                             version=version,
+                             tool_info=tool_info,
+                             inputs=inputs,
+                             outputs=outputs,
+                             comments=comments,
+                             sur_model=sur_model)
+
+    def get_all_samples(self, tool_id: str, batched=False, as_array=False):
+        """ Get all the samples from the database for a certain tool_id. See DB.get_all_samples for the format of the
+        returned data.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :param batched: Switch to 'batch' data per run and sample number, changes output dict
+        :param as_array: Return numpy arrays from the columnar store instead of lists
+        :return: input and output dictionaries containing all samples for specified tool
+        :rtype: [dict, dict]
+        """
+        if as_array:
+            assert not batched, "Batched samples can not be returned as array"
+            return self.get_column_store(tool_id).get_columns()
+
+        tool = self.get_tool(tool_id)
+        assert tool is not None, "Invalid tool_id provided"
+
+        inputs = {input_variable: list() for input_variable in tool['inputs']}
+        outputs = {output_variable: list() for output_variable in tool['outputs']}
+
+        samples = self.connection.execute('SELECT tool_id, run_id, sample_in_run, input, output, sparse FROM samples '
+                                          'WHERE tool_id = ? ORDER BY seq', (tool_id,))
+
+        if batched:
+            data = {}
+            for sample in samples:
+                input_data, output_data = self._decode_sample_data(sample)
+
+                if sample['run_id'] not in data:
+                    data[sample['run_id']] = {}
+
+                data[sample['run_id']][sample['sample_in_run']] = \
+                    {'input': {variable: input_data[variable] for variable in inputs},
+                     'output': {variable: output_data[variable] for variable in outputs}}
+
+            return data
+        else:
+            for sample in samples:
+                input_data, output_data = self._decode_sample_data(sample)
+                for variable in input_data:
+                    inputs[variable].append(input_data[variable])
+
+                for variable in output_data:
+                    outputs[variable].append(output_data[variable])
+
+            return inputs, outputs
+
+    def delete_runs(self, run_ids):
+        """Delete multiple runs and their samples at once, in a single transaction.
+
+        :param run_ids: uuids of runs in database
+        :type run_ids: list[str]
+        """
+        run_ids = list(dict.fromkeys(run_ids))
+        self._begin()
+
+        tool_ids = set()
+        for chunk in self._chunks(run_ids):
+            tool_ids.update(tool['tool_id'] for tool in
+                            self.connection.execute(f'SELECT tool_id FROM tools WHERE tool_id IN (SELECT DISTINCT '
+                                                    f'tool_id FROM samples WHERE run_id IN ({self._parameters(chunk)}))',
+                                                    chunk))
+        tool_ids = sorted(tool_ids)
+
+        stores = [self.get_column_store(tool_id) for tool_id in tool_ids]
+        for store in stores:
+            store.remove_runs(run_ids)
+
+        for chunk in self._chunks(run_ids):
+            for table in ['samples', 'run_templates', 'runs']:
+                self.connection.execute(f'DELETE FROM {table} WHERE run_id IN ({self._parameters(chunk)})', chunk)
+
+        # Consumers that synchronized before this point can not rely on the change feed anymore for these tools
+        if tool_ids:
+            seq = self._next_seq()
+            self.connection.executemany('UPDATE tools SET seq = ?, reset_seq = ? WHERE tool_id = ?',
+                                        [(seq, seq, tool_id) for tool_id in tool_ids])
+            for store in stores:
+                store.seq = seq
+
+        self.save_databases()
+
+    def get_tool_seq(self, tool_id: str) -> int:
+        """Get the version of a tool: the sequence number of the last change to its samples. Increases monotonically.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :rtype: int
+        """
+        tool = self.connection.execute('SELECT seq, reset_seq FROM tools WHERE tool_id = ?', (tool_id,)).fetchone()
+        assert tool is not None, "Invalid tool_id provided"
+
+        last_sample = self.connection.execute('SELECT MAX(seq) FROM samples WHERE tool_id = ?', (tool_id,)).fetchone()
+        return max(tool['seq'], last_sample[0] or 0)
+
+    def get_samples_since(self, tool_id: str, seq: int):
+        """Change feed of the samples of a tool. See DB.get_samples_since.
+
+        :param tool_id: uuid of tool in database
+        :type tool_id: str
+        :param seq: sequence number of last synchronization. 0 to get all samples
+        :type seq: int
+        :return: samples (ordered on their 'seq'), current version of the tool, full
+        :rtype: [list[dict], int, bool]
+        """
+        tool_seq = self.get_tool_seq(tool_id)
+        reset_seq = self.connection.execute('SELECT reset_seq FROM tools WHERE tool_id = ?', (tool_id,)).fetchone()[0]
+
+        full = reset_seq > seq
+        if full:
+            seq = 0
+
+        samples = self.connection.execute('SELECT * FROM samples WHERE tool_id = ? AND seq > ? ORDER BY seq',
+                                          (tool_id, seq))
+        return [self._row_to_sample(sample) for sample in samples], tool_seq, full
+
+    def save_databases(self):
+        if self._batch_depth > 0:  # Committed when the batch is closed
+            return
+
+        self.connection.commit()
+        with self._lock:
+            self._save_column_stores()
+
+    def reload_databases(self):
+        """Queries always read the last committed state of the database, there is nothing to reload."""
+        pass
+
+    def migrate_from_json(self):
+        """Import an existing JSON workspace (tool_db.json, run_db.json, sample_db.json and the journal, if present)
+        into the SQLite database. Entries that already exist in the SQLite database are skipped. The JSON files are left
+        untouched."""
+        json_db = DB(os.path.dirname(self.db_location))
+        tool_db = json_db.tool_db
+        run_db = json_db.run_db
+        sample_db = json_db.sample_db
+
+        self._begin()
+        for tool_id, tool in tool_db.items():
+            self._insert_tool(tool_id, tool, replace=False)
+
+        for run_id, run in run_db.items():
+            self.connection.execute('INSERT OR IGNORE INTO runs (run_id, timestamp, run_start_time, platform, comments, '
+                                    'processed, run_file) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (run_id, run['timestamp'], run['run_start_time'], run['platform'],
+                                     run['comments'], run['processed'], run['run_file']))
+
+        self._insert_samples(list(sample_db.items()), replace=False)
+
+        self.connection.commit()
+        print(f'Migrated {len(tool_db)} tools, {len(run_db)} runs and {len(sample_db)} samples to {self.sqlite_db_path}')
+
+    def _find_existing_hashes(self, tool_id, hashes: list[str]) -> set:
+        """Find which of the provided sample hashes are already stored for a tool. Starts the write transaction, so no
+        other process can add the same samples before they are stored."""
+        self._begin()
+        existing_hashes = set()
+        for chunk in self._chunks(hashes):
+            rows = self.connection.execute(f'SELECT hash FROM samples WHERE tool_id = ? AND hash IN '
+                                           f'({self._parameters(chunk)})', (tool_id, *chunk))
+            existing_hashes.update(row['hash'] for row in rows)
+
+        return existing_hashes
+
+    def _store_samples(self, samples: list[tuple[str, dict]], unique: bool = False):
+        """Store samples. Duplicates are already excluded within the write transaction, see _find_existing_hashes."""
+        self._begin()
+        self._insert_samples(samples)
+
+    def _begin_batch(self):
+        """Called when the outermost batch is opened. Uncommitted changes made before the batch are kept apart by a
+        savepoint, so only the changes of the batch are rolled back when it fails."""
+        self._batch_start = self.connection.in_transaction
+        if self._batch_start:
+            self.connection.execute('SAVEPOINT batch')
+
+    def _discard_batch(self):
+        """Called when a batch is closed by an exception. All changes made within the batch are rolled back."""
+        if self._batch_start:
+            self.connection.execute('ROLLBACK TO batch')
+            self.connection.execute('RELEASE batch')
+        else:
+            self.connection.rollback()
+        self._batch_start = None
+        self._column_stores = {}
+        self._sparse_encoder = SparseEncoder()
+
+    def _begin(self):
+        """Start a write transaction, unless one is already active. The write lock is acquired immediately: a
+        transaction that reads first and upgrades to a write later could fail when another process wrote in between."""
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+    def _next_seq(self) -> int:
+        """Hand out a new sequence number from the counter that is also used for the sample sequence numbers."""
+        self.connection.execute("INSERT OR IGNORE INTO sqlite_sequence (name, seq) VALUES ('samples', 0)")
+        self.connection.execute("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = 'samples'")
+        return self.connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'samples'").fetchone()[0]
+
+    def _compact_databases(self):
+        """Remove the templates of runs without samples, rebuild the indices and reclaim unused space."""
+        self._begin()
+        self.connection.execute('DELETE FROM run_templates WHERE NOT EXISTS (SELECT 1 FROM samples WHERE '
+                                'samples.tool_id = run_templates.tool_id AND samples.run_id = run_templates.run_id)')
+        self.connection.commit()
+        self._sparse_encoder = SparseEncoder()
+
+        self.connection.execute('REINDEX')
+        self.connection.execute('VACUUM')
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def _get_tool_ids(self):
+        return [tool['tool_id'] for tool in self.connection.execute('SELECT tool_id FROM tools ORDER BY rowid')]
+
+    def _get_run_ids(self):
+        return {run['run_id'] for run in self.connection.execute('SELECT run_id FROM runs')}
+
+    @staticmethod
+    def _chunks(items: list, chunk_size: int = 500):
+        """Split query parameters in chunks, to stay below the maximum amount of parameters in a SQLite query."""
+        for idx in range(0, len(items), chunk_size):
+            yield items[idx:idx + chunk_size]
+
+    @staticmethod
+    def _parameters(chunk: list) -> str:
+        return ', '.join('?' * len(chunk))
+
+    def _count_samples(self, tool_id):
+        return self.connection.execute('SELECT COUNT(*) FROM samples WHERE tool_id = ?', (tool_id,)).fetchone()[0]
+
+    def _iter_samples(self, tool_id):
+        """Iterate over all the samples of a tool, in order of insertion."""
+        samples = self.connection.execute('SELECT * FROM samples WHERE tool_id = ? ORDER BY seq', (tool_id,))
+        return (self._row_to_sample(sample) for sample in samples)
+
+    def _insert_tool(self, tool_id, tool, replace=True):
+        statement = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        self.connection.execute(f'{statement} INTO tools (tool_id, tool_name, kadmos_id, version, sur_model, tool_info, '
+                                f'comments, inputs, outputs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (tool_id,
+                                 tool['tool_name'],
+                                 tool['kadmos_id'],
+                                 tool['version'],
+                                 tool['sur_model'],
+                                 json.dumps(tool['tool_info']),
+                                 json.dumps(tool['comments']),
+                                 json.dumps(tool['inputs']),
+                                 json.dumps(tool['outputs'])))
+
+    def _insert_samples(self, samples: list[tuple[str, dict]], replace=True):
+        encoder = self._sparse_encoder
+        runs = {(sample['tool_id'], sample['run_id']) for _, sample in samples}
+        for tool_id, run_id in runs:
+            self._load_sparse_encoder(tool_id, run_id)
+        n_variables = {tool_id: len(encoder.variables.get(tool_id, [])) for tool_id, _ in runs}
+        new_templates = [run for run in runs if run not in encoder.templates]
+
+        rows = []
+        for sample_id, sample in samples:
+            encoded_input, encoded_output = encoder.encode(sample['tool_id'], sample['run_id'],
+                                                           sample['input'], sample['output'])
+            rows.append((sample_id,
+                         sample['tool_id'],
+                         sample['tool_name'],
+                         sample['run_id'],
+                         sample['sample_in_run'],
+                         sample['hash'],
+                         json.dumps(encoded_input),
+                         json.dumps(encoded_output)))
+
+        # Interning the templates can add variables as well, so the templates are encoded first
+        templates = [(tool_id, run_id, *[json.dumps(template) for template in encoder.encode_template(tool_id, run_id)])
+                     for tool_id, run_id in new_templates]
+        self.connection.executemany('INSERT INTO run_templates (tool_id, run_id, input, output) VALUES (?, ?, ?, ?)',
+                                    templates)
+        self.connection.executemany('INSERT INTO variables (tool_id, var_id, name) VALUES (?, ?, ?)',
+                                    [(tool_id, var_id, encoder.variables[tool_id][var_id])
+                                     for tool_id, n in n_variables.items()
+                                     for var_id in range(n, len(encoder.variables.get(tool_id, [])))])
+
+        statement = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        self.connection.executemany(f'{statement} INTO samples (sample_id, tool_id, tool_name, run_id, sample_in_run, '
+                                    f'hash, input, output, sparse) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)', rows)
+
+    def _load_sparse_encoder(self, tool_id, run_id):
+        """Load the variables of a tool and the template of a run that are not in the encoder yet, e.g. because they
+        are added by another process."""
+        encoder = self._sparse_encoder
+        variables = self.connection.execute('SELECT name FROM variables WHERE tool_id = ? AND var_id >= ? '
+                                            'ORDER BY var_id', (tool_id, len(encoder.variables.get(tool_id, []))))
+        for variable in variables:
+            encoder.intern(tool_id, variable['name'])
+
+        if (tool_id, run_id) not in encoder.templates:
+            template = self.connection.execute('SELECT input, output FROM run_templates WHERE tool_id = ? AND '
+                                               'run_id = ?', (tool_id, run_id)).fetchone()
+            if template is not None:
+                encoder.decode_template(tool_id, run_id, json.loads(template['input']), json.loads(template['output']))
+
+    def _decode_sample_data(self, row):
+        """Get the input and output data of a sample row.
+
+        :rtype: [dict, dict]
+        """
+        input_data = json.loads(row['input'])
+        output_data = json.loads(row['output'])
+        if not row['sparse']:  # Stored before the sparse format was introduced
+            return input_data, output_data
+
+        try:
+            return self._sparse_encoder.decode(row['tool_id'], row['run_id'], input_data, output_data)
+        except (KeyError, IndexError):
+            self._load_sparse_encoder(row['tool_id'], row['run_id'])
+            return self._sparse_encoder.decode(row['tool_id'], row['run_id'], input_data, output_data)
+
+    def _row_to_sample(self, row):
+        input_data, output_data = self._decode_sample_data(row)
+        return dict(tool_id=row['tool_id'],
+                    tool_name=row['tool_name'],
+                    run_id=row['run_id'],
+                    input=input_data,
+                    output=output_data,
+                    sample_in_run=row['sample_in_run'],
+                    hash=row['hash'],
+                    seq=row['seq'])
+
+    def _initialize_databases(self):
+        if not os.path.isdir(self.db_location):
+            os.mkdir(self.db_location)
+        os.makedirs(self.data_folder, exist_ok=True)
+
+    def _load_databases(self):
+        migrate = not os.path.isfile(self.sqlite_db_path) and os.path.isfile(self.sample_db_path)
+
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS tools (
+                tool_id TEXT PRIMARY KEY,
+                tool_name TEXT,
+                kadmos_id TEXT,
+                version,
+                sur_model INTEGER,
+                tool_info TEXT,
+                comments TEXT,
+                inputs TEXT,
+                outputs TEXT,
+                seq INTEGER DEFAULT 0,
+                reset_seq INTEGER DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS idx_tools_kadmos_id ON tools (kadmos_id, version, sur_model);
+
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                timestamp TEXT,
+                run_start_time TEXT,
+                platform TEXT,
+                comments TEXT,
+                processed INTEGER,
+                run_file TEXT);
+
+            CREATE TABLE IF NOT EXISTS samples (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                sample_id TEXT UNIQUE,
+                tool_id TEXT,
+                tool_name TEXT,
+                run_id TEXT,
+                sample_in_run INTEGER,
+                hash,
+                input TEXT,
+                output TEXT,
+                sparse INTEGER DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS idx_samples_tool_id ON samples (tool_id);
+            CREATE INDEX IF NOT EXISTS idx_samples_run_id ON samples (run_id);
+            CREATE INDEX IF NOT EXISTS idx_samples_run_tool_sample ON samples (run_id, tool_name, sample_in_run);
+            CREATE INDEX IF NOT EXISTS idx_samples_hash ON samples (hash);
+
+            CREATE TABLE IF NOT EXISTS variables (
+                tool_id TEXT,
+                var_id INTEGER,
+                name TEXT,
+                PRIMARY KEY (tool_id, var_id));
+
+            CREATE TABLE IF NOT EXISTS run_templates (
+                tool_id TEXT,
+                run_id TEXT,
+                input TEXT,
+                output TEXT,
+                PRIMARY KEY (tool_id, run_id));
+            CREATE INDEX IF NOT EXISTS idx_run_templates_run_id ON run_templates (run_id);
+            """)
+
+        # Databases created before the change feed and the sparse format were introduced miss these columns
+        for table, column in [('tools', 'seq'), ('tools', 'reset_seq'), ('samples', 'sparse')]:
+            columns = [info['name'] for info in self.connection.execute(f'PRAGMA table_info({table})')]
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER DEFAULT 0')
+
+        if migrate:
+            self.migrate_from_json()
+
+        self._rehash_legacy_samples()
+
+    def _rehash_legacy_samples(self):
+        """Samples stored with the process-salted hash of older versions get the deterministic content hash."""
+        legacy_samples = self.connection.execute("SELECT seq, tool_id, run_id, input, output, sparse FROM samples "
+                                                 "WHERE typeof(hash) != 'text'").fetchall()
+        if legacy_samples:
+            self._begin()
+        for sample in legacy_samples:
+            sample_hash = self.get_sample_hash(*self._decode_sample_data(sample))
+            self.connection.execute('UPDATE samples SET hash = ? WHERE seq = ?', (sample_hash, sample['seq']))
+
+        if legacy_samples:
+            self.connection.commit()
+
+    def _dump_databases(self):
+        if self._batch_depth > 0:  # Committed when the batch is closed
+            return
+
+        self.connection.commit()
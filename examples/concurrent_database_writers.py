@@ -0,0 +1,89 @@
+"""Stress test of the database with multiple processes that ingest runs into the same workspace at the same time.
+
+Every writer process registers the same tool and adds its own runs with samples. Afterwards the workspace is checked
+for lost or duplicated tools, runs and samples, and for consistency of the sequence numbers and the column store.
+
+Usage: python concurrent_database_writers.py [json|journal|sqlite] [n_writers] [n_runs] [n_samples]
+"""
+import sys
+import shutil
+import tempfile
+from datetime import datetime
+from multiprocessing import Process
+
+from sas.database.db import DB
+from sas.database.sqlite_db import SQLiteDB
+
+
+def open_database(workspace, backend):
+    if backend == 'sqlite':
+        return SQLiteDB(workspace)
+    return DB(workspace, journal=backend == 'journal')
+
+
+def register_tool(database):
+    return database.assert_tool(tool_name='stress',
+                                kadmos_id='stress',
+                                version='1.0',
+                                tool_info={},
+                                inputs=['x', 'writer'],
+                                outputs=['y'])
+
+
+def writer(workspace, backend, idx_writer, n_runs, n_samples):
+    database = open_database(workspace, backend)
+    tool_id = register_tool(database)
+
+    for idx_run in range(n_runs):
+        run_id = database.store_run_information(platform='stress', run_start_time=datetime.now(), run_file='')
+        with database.batch():
+            database.add_samples_to_tool(tool_id=tool_id,
+                                         run_id=run_id,
+                                         batch=[dict(input={'x': idx_run * n_samples + idx_sample,
+                                                            'writer': idx_writer},
+                                                     output={'y': float(idx_sample)},
+                                                     sample_in_run=idx_sample) for idx_sample in range(n_samples)])
+            database.mark_run_as_processed(run_id)
+
+
+def check(workspace, backend, n_writers, n_runs, n_samples):
+    database = open_database(workspace, backend)
+    tool_id = register_tool(database)
+
+    samples, tool_seq, _ = database.get_samples_since(tool_id, 0)
+    n_expected = n_writers * n_runs * n_samples
+    assert len(samples) == n_expected, f'{len(samples)} samples found, {n_expected} expected'
+
+    seqs = [sample['seq'] for sample in samples]
+    assert seqs == sorted(set(seqs)), 'Sequence numbers are not unique and increasing'
+    assert tool_seq >= seqs[-1], 'Version of tool is behind on its samples'
+
+    keys = {(sample['input']['writer'], sample['input']['x']) for sample in samples}
+    assert len(keys) == n_expected, 'Samples are duplicated or lost'
+
+    run_ids = {sample['run_id'] for sample in samples}
+    assert len(run_ids) == n_writers * n_runs, 'Runs are lost'
+    assert all(database.get_run_data('processed', run_id) for run_id in run_ids), 'Runs are not marked as processed'
+
+    inputs, _ = database.get_all_samples(tool_id, as_array=True)
+    assert len(inputs['x']) == n_expected, 'Column store is out of sync with the sample database'
+    print(f'{backend}: {n_writers} writers stored {n_expected} samples in {n_writers * n_runs} runs without conflicts')
+
+
+if __name__ == '__main__':
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'sqlite'
+    n_writers, n_runs, n_samples = [int(arg) for arg in sys.argv[2:5]] or [8, 10, 25]
+
+    workspace = tempfile.mkdtemp(prefix='sas_stress_')
+    try:
+        processes = [Process(target=writer, args=(workspace, backend, idx_writer, n_runs, n_samples))
+                     for idx_writer in range(n_writers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0, 'Writer process failed'
+
+        check(workspace, backend, n_writers, n_runs, n_samples)
+    finally:
+        shutil.rmtree(workspace)
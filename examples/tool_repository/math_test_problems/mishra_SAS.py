@@ -4,19 +4,17 @@ import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import cm
 
-@np.vectorize
 def predict_sur_sample(surrogate, x, y):
-    sample ={'/dataSchema/x': x,
-             '/dataSchema/y': y}
+    sample = {'/dataSchema/x': np.ravel(x),
+              '/dataSchema/y': np.ravel(y)}
 
-    output = surrogate.predict(sample)
-    return output['/dataSchema/f']
+    output = surrogate.predict_batch(sample)
+    return output['/dataSchema/f'].reshape(np.shape(x))
 
-@np.vectorize
 def predict_sur_variance(surrogate, x, y):
 
-    output = surrogate.surrogate.predict_variances(np.array([x, y]).reshape((1, -1)))
-    return output[0]
+    output = surrogate.surrogate.predict_variances(np.column_stack([np.ravel(x), np.ravel(y)]))
+    return output.reshape(np.shape(x))
 
 def calculate_RMSE(surrogate, x_limits, y_limits, resolution=200):
     x_range = np.linspace(x_limits[0], x_limits[1], resolution)
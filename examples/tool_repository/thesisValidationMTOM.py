@@ -191,9 +191,7 @@ def main():
             error_loo.append(sas.surrogate_models[sm_key].validate(method='leave-one-out'))
 
             # Clean DB for next run
-            sas.database.delete_run(run_id=run_id_doe)
-            sas.database.delete_run(run_id=run_id_opt)
-            sas.database.delete_run(run_id=run_id_check)
+            sas.database.delete_runs([run_id_doe, run_id_opt, run_id_check])
 
             sas.surrogate_models.pop(sm_key)
 
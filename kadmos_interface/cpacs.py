@@ -1,9 +1,35 @@
+import re
+
+import numpy as np
 from lxml import etree
 from lxml.etree import ElementTree
 
+vector_separator = ';'
+
+
+def parse_value(text: str):
+    """Parse the text of a CPACS element. Vectors, stored as values separated by ';', are parsed into a numpy array.
+
+    :rtype: float | np.ndarray
+    """
+    if vector_separator in text:
+        return np.fromstring(text.strip().rstrip(vector_separator), sep=vector_separator)
+    return float(text)
+
+
+def format_value(value) -> str:
+    """Format a value as text of a CPACS element, the inverse of parse_value."""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return vector_separator.join(str(element) for element in value)
+    return str(value)
+
 
 class PortableCpacs:
-    """Tiny CPACS class capable of reading and writing to a CPACS file"""
+    """Tiny CPACS class capable of reading and writing to a CPACS file.
+
+    Elements found by get_value and update_value are cached per xpath, so repeated access to the same variables does not
+    evaluate the xpath again. Elements are only added by build_xpath, which invalidates the cached xpaths of which the
+    first match can change by the added elements. Call clear_cache after changing the tree through the root directly."""
     def __init__(self, cpacs_in: str = None):
         self.parser = etree.XMLParser(remove_blank_text=True)
         if cpacs_in is not None:
@@ -11,53 +37,501 @@ class PortableCpacs:
         else:
             self.root = None
 
+        self._elements = {}  # xpath -> first matching element
+        self._cached_xpaths = {}  # tags of the steps of a simple xpath (None if not simple) -> set of cached xpaths
+
     def get_values(self, xpaths: list[str]) -> list:
         values = [self.get_value(xpath) for xpath in xpaths]
         return values
 
-    def get_value(self, xpath: str) -> float:
-        return float(self.root.xpath(xpath)[0].text)
+    def get_value(self, xpath: str):
+        element = self.find(xpath)
+        assert element is not None, f'{xpath} not found in CPACS'
+        return parse_value(element.text)
 
     def update_value(self, xpath: str, value: float) -> None:
-        if self.root is not None:
-            el = self.root.xpath(xpath)
-        else:
-            el = None
+        el = self.find(xpath)
+        if el is None:
+            el = self.build_xpath(xpath)[0]
+
+        el.text = format_value(value)
+
+    def find(self, xpath: str):
+        """Get the first element matching an xpath, from the cache if it was found before.
+
+        :return: element, None if no element matches the xpath
+        """
+        element = self._elements.get(xpath)
+        if element is None and self.root is not None:
+            result = self.root.xpath(xpath)
+            if result:
+                element = result[0]
+                self._cache(xpath, element)
 
-        if not el:
-            el = self.build_xpath(xpath)
+        return element
 
-        el[0].text = str(value)
+    def clear_cache(self):
+        self._elements.clear()
+        self._cached_xpaths.clear()
 
-    def build_xpath(self, xpath) -> str:
+    def build_xpath(self, xpath) -> list:
         """Update (or set) an xpath that does not yet exist in a cpacs document.
 
-        :param xpath: xpath of not-yet existing element
+        Walks down from the deepest existing ancestor and creates the missing elements in one pass. Attribute predicates
+        of the created steps (e.g. wing[@uID="wing1"]) are set as attributes of the created elements.
+
+        :param xpath: absolute, simple xpath of not-yet existing element, e.g. /cpacs/vehicles/aircraft/model/wings
         :type xpath: str
-        :return: list of all created elements
+        :return: list with the element of the xpath
         :rtype: list
         """
-        components = xpath.split("/")
+        parsed = CpacsExtractor._parse_step_prefixes(xpath) if xpath.startswith('/') else None
+        assert parsed is not None, f'Only absolute, simple xpaths can be built, {xpath} is not'
+        steps, prefixes = parsed  # prefixes[i] is the xpath of steps[:i + 1], predicates can contain '/'
 
         if self.root is None:
             element = self.parser.makeelement
-            self.root = element(components[1])
+            self.root = element(steps[0][0])
+            self.clear_cache()
+        assert self.root.tag == steps[0][0], f'Root element of {xpath} does not match the CPACS root {self.root.tag}'
 
-        previous_el = self.root
+        # Start at the deepest cached ancestor, the ancestors of recently built elements are cached, and walk down
+        # through the existing elements. A child of the first match of an xpath is the first match of the xpath of the child
+        depth = len(steps) - 1
+        while depth > 1 and prefixes[depth - 1] not in self._elements:
+            depth -= 1
+        previous_el = self._elements.get(prefixes[depth - 1], self.root) if depth > 1 else self.root
+        depth = max(depth, 1)
 
-        current_xpath = '/'
-        for component in components:
-            if component == '':
-                continue
-            if not self.root.xpath(current_xpath + '/' + component):
-                updated_el = etree.SubElement(previous_el, component)
+        while depth < len(steps):
+            child_xpath = prefixes[depth]
+            child = self._find_child(previous_el, steps[depth])
+            if child is None:
+                child = self.find(child_xpath)  # Can still exist below a later match of the xpath of previous_el
+                if child is None:
+                    break
             else:
-                updated_el = self.root.xpath(current_xpath + '/' + component)[0]
+                self._cache(child_xpath, child, steps[:depth + 1])
+
+            previous_el = child
+            depth += 1
+
+        # Added elements can only become the first match of cached xpaths with the same tags, or that are not simple
+        for cached_xpath in self._cached_xpaths.pop(None, ()):
+            del self._elements[cached_xpath]
 
-            previous_el = updated_el
-            current_xpath += component + '/'
+        for idx_step in range(depth, len(steps)):
+            tag, position, attribute, value = steps[idx_step]
+            assert position is None or position == len(previous_el.findall(tag)) + 1, \
+                f'Can not build {xpath}, the elements before position {position} of {tag} do not exist'
 
-        return self.root.xpath(xpath)
+            previous_el = etree.SubElement(previous_el, tag)
+            if attribute is not None:
+                previous_el.set(attribute, value)
+
+            tags = tuple(step[0] for step in steps[:idx_step + 1])
+            for cached_xpath in self._cached_xpaths.pop(tags, ()):
+                del self._elements[cached_xpath]
+            self._cache(prefixes[idx_step], previous_el, steps[:idx_step + 1])
+
+        return [previous_el]
 
     def save(self, cpacs_out: str):
-        ElementTree(self.root).write(cpacs_out, method='xml', pretty_print=True, encoding='UTF-8')
\ No newline at end of file
+        ElementTree(self.root).write(cpacs_out, method='xml', pretty_print=True, encoding='UTF-8')
+
+    @staticmethod
+    def _find_child(element, step: tuple):
+        tag, required_position, attribute, value = step
+        for position, child in enumerate(element.iterchildren(tag), start=1):
+            if required_position is not None and required_position != position:
+                continue
+            if attribute is not None and child.get(attribute) != value:
+                continue
+            return child
+
+        return None
+
+    def _cache(self, xpath: str, element, steps: list[tuple] = None):
+        if steps is None and xpath.startswith('/'):
+            steps = CpacsExtractor._parse_steps(xpath)
+        tags = tuple(step[0] for step in steps) if steps is not None else None
+
+        self._elements[xpath] = element
+        self._cached_xpaths.setdefault(tags, set()).add(xpath)
+
+
+class CpacsExtractor:
+    """Extracts the values of a fixed list of xpaths from CPACS files, e.g. the input variables of a discipline.
+
+    Simple xpaths, consisting of child steps with an optional position or attribute predicate (e.g.
+    /cpacs/vehicles/aircraft/model/wings/wing[@uID="wing1"]/sections/section[2]/x), are merged into a tree of steps.
+    This tree is resolved in a single walk over the CPACS tree, so elements with many children are scanned once for all
+    xpaths instead of once per xpath. Other xpaths are compiled once to etree.XPath objects. A single parser is reused
+    for all files. Like an xpath query, every xpath resolves to its first match in document order."""
+    step_pattern = re.compile(r'/([A-Za-z_][\w.\-]*)(?:\[(\d+)\]|\[@([A-Za-z_][\w.\-]*)=(["\'])([^"\']*)\4\])?')
+
+    def __init__(self, xpaths: list[str]):
+        self.xpaths = list(xpaths)
+        self.parser = etree.XMLParser(remove_blank_text=True)
+
+        self._absolute_steps = _StepNode()  # Steps of xpaths starting at the document, the first step is the root
+        self._relative_steps = _StepNode()  # Steps of xpaths starting at the root element
+        self._compiled_xpaths = {}  # index of xpath -> etree.XPath, for xpaths that are not simple
+        for idx_xpath, xpath in enumerate(self.xpaths):
+            steps = self._parse_steps(xpath)
+            if steps is None:
+                self._compiled_xpaths[idx_xpath] = etree.XPath(xpath)
+            else:
+                node = self._absolute_steps if xpath.startswith('/') else self._relative_steps
+                node.add(idx_xpath, steps)
+
+    def __reduce__(self):
+        # Parsers and compiled xpaths can not be pickled, they are rebuilt from the xpaths
+        return self.__class__, (self.xpaths,)
+
+    def extract(self, cpacs_file) -> dict:
+        """Parse a CPACS file and extract the values of all xpaths.
+
+        :param cpacs_file: path or binary file object of CPACS file
+        :return: values in format {'xpath': float}, vectors as np.ndarray
+        :rtype: dict
+        """
+        root = ElementTree(file=cpacs_file, parser=self.parser).getroot()
+        return self.extract_from_root(root, source=cpacs_file)
+
+    def extract_from_root(self, root, source: str = 'CPACS') -> dict:
+        """Extract the values of all xpaths from a parsed CPACS tree.
+
+        :param root: root element of CPACS tree
+        :param source: description of the CPACS tree for error messages
+        :return: values in format {'xpath': float}, vectors as np.ndarray
+        :rtype: dict
+        """
+        elements = [None] * len(self.xpaths)
+        self._walk([root], self._absolute_steps, elements)
+        self._walk(root, self._relative_steps, elements)
+        for idx_xpath, compiled_xpath in self._compiled_xpaths.items():
+            result = compiled_xpath(root)
+            if result:
+                elements[idx_xpath] = result[0]
+
+        values = {}
+        for xpath, element in zip(self.xpaths, elements):
+            assert element is not None, f'{xpath} not found in {source}'
+            values[xpath] = parse_value(element.text)
+        return values
+
+    @classmethod
+    def _parse_steps(cls, xpath: str):
+        """Split a simple xpath in steps (tag, position, attribute, value). None if the xpath is not simple."""
+        parsed = cls._parse_step_prefixes(xpath)
+        return parsed[0] if parsed is not None else None
+
+    @classmethod
+    def _parse_step_prefixes(cls, xpath: str):
+        """Split a simple xpath in steps, see _parse_steps, and the xpaths up to and including every step. These are
+        taken from the text of the xpath, as predicates can contain '/'.
+
+        :return: steps and prefixes, prefixes[i] is the xpath of steps[:i + 1]. None if the xpath is not simple
+        :rtype: [list[tuple], list[str]]
+        """
+        path = xpath if xpath.startswith('/') else '/' + xpath
+        steps = []
+        prefixes = []
+        end = 0
+        for match in cls.step_pattern.finditer(path):
+            if match.start() != end:
+                return None
+            tag, position, attribute, _, value = match.groups()
+            steps.append((tag, int(position) if position else None, attribute, value))
+            end = match.end()
+            prefixes.append(path[:end])
+
+        if end != len(path) or not steps:
+            return None
+        return steps, prefixes
+
+    @classmethod
+    def _walk(cls, children, node, elements: list):
+        """Resolve the steps of node for all children of an element, depth first and in document order."""
+        positions = {}
+        for child in children:
+            child_steps = node.children.get(child.tag)
+            if child_steps is None:
+                continue
+
+            position = positions[child.tag] = positions.get(child.tag, 0) + 1
+            for (required_position, attribute, value), child_node in child_steps:
+                if required_position is not None and required_position != position:
+                    continue
+                if attribute is not None and child.get(attribute) != value:
+                    continue
+                if all(elements[idx_xpath] is not None for idx_xpath in child_node.xpaths_in_subtree):
+                    continue
+
+                for idx_xpath in child_node.xpaths:
+                    if elements[idx_xpath] is None:
+                        elements[idx_xpath] = child
+                if child_node.children:
+                    cls._walk(child, child_node, elements)
+
+
+class CpacsStreamReader(CpacsExtractor):
+    """Extracts the values of a fixed list of xpaths from CPACS files without loading the complete tree in memory.
+
+    The file is read with etree.iterparse. Only the elements on the steps of the xpaths are matched, other subtrees are
+    passed without any lookups and every element is freed as soon as it is closed. Reading stops as soon as all xpaths
+    are found, so values near the start of a large CPACS file are read without parsing the rest of it. Like the
+    CpacsExtractor, every xpath resolves to its first match in document order. Only simple xpaths can be streamed, if
+    any xpath is not simple the complete file is parsed instead."""
+    def extract(self, cpacs_file) -> dict:
+        """Read the values of all xpaths from a CPACS file.
+
+        :param cpacs_file: path or binary file object of CPACS file
+        :return: values in format {'xpath': float}, vectors as np.ndarray
+        :rtype: dict
+        """
+        if self._compiled_xpaths:
+            return super().extract(cpacs_file)
+
+        elements_text = [None] * len(self.xpaths)
+        n_remaining = len(self.xpaths)
+
+        stack = [([self._absolute_steps], {})]  # Per open element: matching step nodes, positions of children per tag
+        for event, element in etree.iterparse(cpacs_file, events=('start', 'end'), remove_blank_text=True):
+            if event == 'start':
+                nodes, positions = stack[-1]
+                matched_nodes = []
+                if nodes:
+                    tag = element.tag
+                    position = None
+                    for node in nodes:
+                        child_steps = node.children.get(tag)
+                        if child_steps is None:
+                            continue
+                        if position is None:
+                            position = positions[tag] = positions.get(tag, 0) + 1
+
+                        for (required_position, attribute, value), child_node in child_steps:
+                            if required_position is not None and required_position != position:
+                                continue
+                            if attribute is not None and element.get(attribute) != value:
+                                continue
+                            if all(elements_text[idx_xpath] is not None
+                                   for idx_xpath in child_node.xpaths_in_subtree):
+                                continue
+                            matched_nodes.append(child_node)
+
+                if len(stack) == 1:  # The root element is the context of relative xpaths
+                    matched_nodes.append(self._relative_steps)
+                stack.append((matched_nodes, {}))
+                continue
+
+            # The text of an element is only complete at its end
+            matched_nodes, _ = stack.pop()
+            for node in matched_nodes:
+                for idx_xpath in node.xpaths:
+                    if elements_text[idx_xpath] is None:
+                        elements_text[idx_xpath] = element.text or ''
+                        n_remaining -= 1
+            if n_remaining == 0:
+                break
+
+            # Free the closed element and its preceding siblings, they are not needed anymore
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+        values = {}
+        for xpath, text in zip(self.xpaths, elements_text):
+            assert text is not None, f'{xpath} not found in {cpacs_file}'
+            values[xpath] = parse_value(text)
+        return values
+
+
+class CpacsResponseWriter:
+    """Writes the response of a deployed surrogate model to CPACS files with as little work per call as possible.
+
+    At deploy time the locations of the input and output elements are precomputed from a template CPACS file. At run
+    time the elements are found by their location (falling back on the xpath if the file differs from the template),
+    only their text is patched and the tree is serialized without pretty printing.
+
+    If the markup of an input file equals the markup of the template, only the text of elements differs, the file is not
+    parsed at all: the input values are read from and the output values are spliced into the raw bytes."""
+    start_tag_pattern = re.compile(rb'<([^!?/<>\s]+)(?:\s[^<>]*?)?(/?)>')
+
+    def __init__(self, input_xpaths: list[str], output_xpaths: list[str], template_cpacs: str = None):
+        """
+        :param input_xpaths: xpaths of the inputs of the surrogate model
+        :param output_xpaths: xpaths of the outputs of the surrogate model
+        :param template_cpacs: CPACS file with the layout of the expected input files, e.g. the initial CPACS file of
+                               the workflow. Elements missing in the template are created. If None, elements are always
+                               found by their xpath
+        """
+        self.input_xpaths = list(input_xpaths)
+        self.output_xpaths = list(output_xpaths)
+        self.parser = etree.XMLParser(remove_blank_text=True)
+
+        self.locations = {}  # xpath -> list of (child index, tag) from the root to the element
+        self.splice_pattern = None
+        if template_cpacs is not None:
+            template = PortableCpacs(template_cpacs)
+            for xpath in self.input_xpaths + self.output_xpaths:
+                if template.find(xpath) is None:
+                    template.update_value(xpath, 0)
+
+            for xpath in self.input_xpaths + self.output_xpaths:
+                element = template.find(xpath)
+                location = []
+                while element.getparent() is not None:
+                    location.append((element.getparent().index(element), element.tag))
+                    element = element.getparent()
+                self.locations[xpath] = location[::-1]
+
+            self.splice_pattern = self._build_splice_pattern(self._read(template_cpacs), template)
+
+        self.n_spliced = 0
+        self.n_parsed = 0
+
+    def __getstate__(self):
+        # The parser can not be pickled, it is rebuilt. The compiled pattern is pickled as its source
+        state = self.__dict__.copy()
+        del state['parser']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parser = etree.XMLParser(remove_blank_text=True)
+
+    def write(self, cpacs_in: str, cpacs_out: str, predict):
+        """Read the inputs from an input CPACS file, predict the response and write the output CPACS file.
+
+        :param cpacs_in: path of input CPACS file
+        :param cpacs_out: path of output CPACS file
+        :param predict: function that returns the response {output xpath: value} for the inputs {input xpath: value}
+        """
+        data = self._read(cpacs_in)
+
+        match = self.splice_pattern.fullmatch(data) if self.splice_pattern is not None else None
+        if match is not None:
+            response = predict({xpath: parse_value(match.group(f'i{idx_xpath}').decode('utf-8'))
+                                for idx_xpath, xpath in enumerate(self.input_xpaths)})
+
+            # Splice the outputs into the input file, in order of their location in the file
+            spans = sorted((match.span(f'o{idx_xpath}'), idx_xpath) for idx_xpath in range(len(self.output_xpaths)))
+            chunks = []
+            end = 0
+            for (start_output, end_output), idx_xpath in spans:
+                chunks.append(data[end:start_output])
+                chunks.append(format_value(response[self.output_xpaths[idx_xpath]]).encode('utf-8'))
+                end = end_output
+            chunks.append(data[end:])
+
+            self._write(cpacs_out, b''.join(chunks))
+            self.n_spliced += 1
+            return
+
+        cpacs = PortableCpacs()
+        cpacs.root = etree.fromstring(data, parser=self.parser)
+
+        response = predict({xpath: parse_value(self._find(cpacs, xpath).text) for xpath in self.input_xpaths})
+        for xpath in self.output_xpaths:
+            element = self._find(cpacs, xpath)
+            if element is None:
+                element = cpacs.build_xpath(xpath)[0]
+            element.text = format_value(response[xpath])
+
+        self._write(cpacs_out, etree.tostring(cpacs.root, xml_declaration=True, encoding='UTF-8'))
+        self.n_parsed += 1
+
+    def _find(self, cpacs: PortableCpacs, xpath: str):
+        """Find an element by its location in the template, or by its xpath if the file differs from the template."""
+        if xpath not in self.locations:
+            return cpacs.find(xpath)
+
+        element = cpacs.root
+        for index, tag in self.locations[xpath]:
+            if index >= len(element) or element[index].tag != tag:
+                return cpacs.find(xpath)
+            element = element[index]
+
+        return element
+
+    def _build_splice_pattern(self, data: bytes, template: PortableCpacs):
+        """Regular expression that matches files with the same markup as the template. The text of the inputs and
+        outputs is captured in groups i<index> and o<index>. None if the template can not be spliced safely."""
+        if b'<!--' in data or b'<![CDATA[' in data or b'<!DOCTYPE' in data:
+            return None
+
+        # Relate the start tags in the file to the elements in document order, and check that they correspond
+        elements = [element for element in template.root.iter() if isinstance(element.tag, str)]
+        start_tags = list(self.start_tag_pattern.finditer(data))
+        if len(start_tags) != len(elements):
+            return None
+
+        groups = {}  # index of element -> group name
+        for idx_xpath, xpath in enumerate(self.input_xpaths):
+            groups[elements.index(template.find(xpath))] = f'i{idx_xpath}'
+        for idx_xpath, xpath in enumerate(self.output_xpaths):
+            idx_element = elements.index(template.find(xpath))
+            if idx_element in groups:  # Output that is an input as well, the input is read before it is replaced
+                return None
+            groups[idx_element] = f'o{idx_xpath}'
+
+        pattern = []
+        end = 0
+        for idx_element, (start_tag, element) in enumerate(zip(start_tags, elements)):
+            if start_tag.group(1).decode('utf-8') != element.tag:
+                return None
+            if start_tag.group(2):  # Empty element, it has no text to replace
+                if idx_element in groups:
+                    return None
+                continue
+
+            text_end = data.find(b'<', start_tag.end())
+            if data[start_tag.end():text_end].decode('utf-8').strip() != (element.text or '').strip():
+                return None
+
+            pattern.append(re.escape(data[end:start_tag.end()]))
+            pattern.append(rb'(?P<%s>[^<]*)' % groups[idx_element].encode() if idx_element in groups else rb'[^<]*')
+            end = text_end
+
+        pattern.append(re.escape(data[end:]))
+        return re.compile(b''.join(pattern))
+
+    @staticmethod
+    def _read(file: str) -> bytes:
+        with open(file, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _write(file: str, data: bytes):
+        with open(file, 'wb') as f:
+            f.write(data)
+
+
+class _StepNode:
+    """Node in the tree of xpath steps of the CpacsExtractor."""
+    def __init__(self):
+        self.children = {}  # tag -> list of ((position, attribute, value), _StepNode)
+        self.xpaths = []  # xpaths ending in this node
+        self.xpaths_in_subtree = []
+
+    def add(self, idx_xpath: int, steps: list[tuple]):
+        self.xpaths_in_subtree.append(idx_xpath)
+        if not steps:
+            self.xpaths.append(idx_xpath)
+            return
+
+        tag, *predicate = steps[0]
+        child_steps = self.children.setdefault(tag, [])
+        for child_predicate, child_node in child_steps:
+            if child_predicate == tuple(predicate):
+                break
+        else:
+            child_node = _StepNode()
+            child_steps.append((tuple(predicate), child_node))
+
+        child_node.add(idx_xpath, steps[1:])
@@ -3,14 +3,84 @@ import json
 from .pidoInterface import PIDOInterface
 
 from sas.database.db import DB
+from sas.database.archive import FileArchive
 
 from datetime import datetime
 import os
 import re
+import time
+import hashlib
 import shutil
 import distutils.dir_util
+from concurrent.futures import ProcessPoolExecutor
 
 from sas.core.discipline import Discipline
+from sas.kadmos_interface.cpacs import CpacsStreamReader
+from lxml.etree import ElementTree
+
+
+_worker_extractors = {}  # (discipline_id, 'input' | 'output') -> CPACS extractor of the discipline, per worker process
+
+
+def _init_extraction_worker(extractors: dict):
+    """Provide the CPACS extractors of the disciplines to an extraction worker process, once for all its tasks.
+
+    :param extractors: {(discipline_id, 'input' | 'output'): extractor}
+    """
+    _worker_extractors.clear()
+    _worker_extractors.update(extractors)
+
+
+def _find_execution_files(execution: tuple[str, str, int]):
+    """Find the input and output CPACS file of an execution of a discipline and hash their contents. Runs in the
+    extraction worker processes.
+
+    :param execution: (discipline_id, execution folder, sample_in_run)
+    :return: discipline_id, sample_in_run, input file, hash of input file, output file, hash of output file
+    :rtype: tuple
+    """
+    discipline_id, execution_folder, sample_in_run = execution
+
+    input_file = RCEInterface.find_file_type_in_folders(root_path=os.path.join(execution_folder, "Input"),
+                                                        extension='.xml')
+    assert len(input_file) == 1, f"Multiple input files found for discipline {discipline_id} and run {sample_in_run}."
+
+    output_file = RCEInterface.find_file_type_in_folders(root_path=os.path.join(execution_folder, "Output"),
+                                                         extension='.xml')
+    assert len(output_file) == 1, f"Multiple output files found for discipline {discipline_id} and run {sample_in_run}."
+
+    return (discipline_id, sample_in_run,
+            input_file[0], _hash_file(input_file[0]),
+            output_file[0], _hash_file(output_file[0]))
+
+
+def _hash_file(file: str) -> str:
+    with open(file, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def _extract_file(task: tuple[str, tuple]):
+    """Extract the values of a CPACS file for all discipline extractors that need it. Runs in the extraction worker
+    processes, the values are returned as plain lists.
+
+    The file is parsed once and the extractors resolve their xpaths on the same tree. Only when all extractors are
+    streaming readers, every extractor reads the file itself, as each of them stops reading as soon as its variables
+    are found.
+
+    :param task: (CPACS file, keys of the extractors in _worker_extractors)
+    :return: values per extractor, in order of the xpaths of the extractor
+    :rtype: list
+    """
+    cpacs_file, keys = task
+    extractors = [_worker_extractors[key] for key in keys]
+    if all(isinstance(extractor, CpacsStreamReader) for extractor in extractors):
+        values = [extractor.extract(cpacs_file) for extractor in extractors]
+    else:
+        root = ElementTree(file=cpacs_file, parser=extractors[0].parser).getroot()
+        values = [extractor.extract_from_root(root, source=cpacs_file) for extractor in extractors]
+
+    return [[extractor_values[xpath] for xpath in extractor.xpaths]
+            for extractor, extractor_values in zip(extractors, values)]
 
 
 class RCEInterface(PIDOInterface):
@@ -27,9 +97,16 @@ class RCEInterface(PIDOInterface):
     def __init__(self, pido_path: str,
                  rce_workspace_path: str = None,
                  test_connection: bool = False,
-                 run_file: str = False):
-
+                 run_file: str = False,
+                 archive: FileArchive = None,
+                 n_workers: int = 1):
+        """
+        :param n_workers: amount of worker processes that extract the samples from the CPACS files of a run. None uses
+                          all CPUs, 1 extracts in the current process
+        """
         self.pido_path = pido_path
+        self.archive = archive  # If provided, run folders are stored in the archive instead of moved to the storage
+        self.n_workers = n_workers
 
         if rce_workspace_path:
             self.rce_workspace = rce_workspace_path
@@ -518,40 +595,106 @@ class RCEInterface(PIDOInterface):
             except OSError as e:
                 print("Error: %s : %s" % (os.path.join(self.output_location, folder_to_copy), e.strerror))
 
-        # Loop over all copied tool folders, extract the input and output files for each run and process the cpacs files
-        for discipline_id in os.listdir(run_processing_folder):  # Folders now have same name as disciplines
+        # Gather the executions of all copied tool folders, extract the samples from their input and output CPACS files
+        # (in parallel if workers are configured) and commit all samples of the run to the database in one batch
+        executions = []
+        disciplines_in_run = {}
+        for discipline_id in sorted(os.listdir(run_processing_folder)):  # Folders now have same name as disciplines
             # Find corresponding discipline object from list of disciplines
             discipline = [discipline for discipline in disciplines if discipline.id == discipline_id]
-            assert len(discipline) == 1, f"Multiple disciplines {discipline_id} found with same ID. Should not be possible."
-            discipline = discipline[0]
+            assert len(discipline) == 1, \
+                f"Multiple disciplines {discipline_id} found with same ID. Should not be possible."
+            disciplines_in_run[discipline_id] = discipline[0]
 
             discipline_run_folder = os.path.join(run_processing_folder, discipline_id)
+            for run in os.listdir(discipline_run_folder):
+                if run.isdigit():
+                    executions.append((discipline_id, os.path.join(discipline_run_folder, run), int(run)))
 
-            # Enter folder, recurse over all the runs
-            runs = os.listdir(discipline_run_folder)
-            for idx_sample, run in enumerate(runs):
-                if not run.isdigit():
-                    continue
+        samples = self._extract_executions(disciplines_in_run, executions)
 
-                input_file = self.find_file_type_in_folders(root_path=os.path.join(discipline_run_folder, run, "Input"),
-                                                            extension='.xml')
-                assert len(input_file) == 1, f"Multiple input files found for discipline {discipline_id} and run {run}."
-                input_file = input_file[0]
+        with database.batch():
+            for discipline_id, discipline in disciplines_in_run.items():
+                discipline.add_extracted_samples(database=database,
+                                                 samples=samples[discipline_id],
+                                                 run_id=run_id)
 
-                output_file = self.find_file_type_in_folders(
-                    root_path=os.path.join(discipline_run_folder, run, "Output"),
-                    extension='.xml')
-                assert len(
-                    output_file) == 1, f"Multiple output files found for discipline {discipline_id} and run {run}."
-                output_file = output_file[0]
+            database.mark_run_as_processed(run_id)
 
-                discipline.add_cpacs_sample(database=database,
-                                            cpacs_in=input_file,
-                                            cpacs_out=output_file,
-                                            run_id=run_id,
-                                            sample_in_run=int(run))
+    def _extract_executions(self, disciplines: dict, executions: list[tuple[str, str, int]]):
+        """Find the input and output CPACS files of the executions of the disciplines and extract their samples. With
+        multiple workers, this is done by a pool of processes.
 
-        database.mark_run_as_processed(run_id)
+        Disciplines often share CPACS files, e.g. when they consume the same coordinator CPACS. Every file is hashed and
+        each unique file is parsed once, after which the CPACS extractors of all disciplines that need the file (see
+        Discipline.get_cpacs_extractors) resolve their variables on it.
+
+        :param disciplines: discipline objects {discipline_id: discipline}
+        :param executions: list of (discipline_id, execution folder, sample_in_run)
+        :return: samples per discipline, ordered on sample_in_run: {discipline_id: [(sample_in_run, input values,
+                 output values), ...]}, with the values in order of the input and output variables of the discipline
+        :rtype: dict
+        """
+        time_started = time.perf_counter()
+        n_workers = self.n_workers if self.n_workers is not None else os.cpu_count()
+        n_workers = max(1, min(n_workers, len(executions)))
+        extractors = {}
+        for discipline_id, discipline in disciplines.items():
+            extractors[(discipline_id, 'input')], extractors[(discipline_id, 'output')] = \
+                discipline.get_cpacs_extractors()
+
+        if n_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_extraction_worker,
+                                           initargs=(extractors,))
+        else:
+            executor = None
+            _init_extraction_worker(extractors)
+        try:
+            execution_files = self._map_tasks(executor, _find_execution_files, executions, n_workers)
+
+            # Gather the extractors that need every unique file
+            unique_files = {}  # hash -> [file, set of extractor keys]
+            for discipline_id, _, input_file, input_hash, output_file, output_hash in execution_files:
+                unique_files.setdefault(input_hash, [input_file, set()])[1].add((discipline_id, 'input'))
+                unique_files.setdefault(output_hash, [output_file, set()])[1].add((discipline_id, 'output'))
+
+            tasks = [(file, tuple(sorted(keys))) for file, keys in unique_files.values()]
+            task_values = self._map_tasks(executor, _extract_file, tasks, n_workers)
+            file_values = {file_hash: dict(zip(task[1], values))
+                           for file_hash, task, values in zip(unique_files, tasks, task_values)}
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            else:
+                _worker_extractors.clear()
+
+        # Give every discipline its slice of the values of its files
+        samples = {discipline_id: [] for discipline_id in disciplines}
+        for discipline_id, sample_in_run, _, input_hash, _, output_hash in execution_files:
+            samples[discipline_id].append((sample_in_run,
+                                           file_values[input_hash][(discipline_id, 'input')],
+                                           file_values[output_hash][(discipline_id, 'output')]))
+        for discipline_samples in samples.values():
+            discipline_samples.sort(key=lambda sample: sample[0])
+
+        time_spent = time.perf_counter() - time_started
+        if executions:
+            n_megabytes = sum(os.path.getsize(file) for file, _ in unique_files.values()) / 1e6
+            print(f'Extracted {len(executions)} samples of {len(disciplines)} disciplines from {len(unique_files)} '
+                  f'unique CPACS files ({2 * len(executions)} files, {n_megabytes:.1f} MB) with {n_workers} worker(s) '
+                  f'in {time_spent:.2f} s ({len(executions) / time_spent:.1f} samples/s, '
+                  f'{n_megabytes / time_spent:.1f} MB/s)')
+
+        return samples
+
+    @staticmethod
+    def _map_tasks(executor, function, tasks: list, n_workers: int):
+        """Apply a function to all tasks, in the pool of the executor if given, and return the results in order."""
+        if executor is None:
+            return [function(task) for task in tasks]
+
+        chunksize = max(1, len(tasks) // (4 * n_workers))
+        return list(executor.map(function, tasks, chunksize=chunksize))
 
     def _cleanup_files(self, disciplines, final_storage_base_folder, run_id):
         """Move all folders to a location where they will indefinitely be stored.
@@ -560,6 +703,8 @@ class RCEInterface(PIDOInterface):
 
         final_storage_base_folder\tool_id\run_id\..
 
+        If an archive is set, the files are stored in the archive instead and the folders are removed.
+
         :param disciplines: List of disciplines objects
         :param final_storage_base_folder: base folder from where the data will be stored
         :param run_id: uuid to identify run in databases
@@ -579,7 +724,11 @@ class RCEInterface(PIDOInterface):
 
             current_folder = os.path.join(run_folder, discipline_id)
 
-            shutil.move(current_folder, destination_path)
+            if self.archive is not None:
+                self.archive.add_folder(current_folder, tool_id=discipline.uuid, run_id=run_id)
+                shutil.rmtree(current_folder)
+            else:
+                shutil.move(current_folder, destination_path)
 
         os.rmdir(run_folder)
 
@@ -756,7 +905,8 @@ class RCEInterface(PIDOInterface):
 
         return timeline
 
-    def find_file_type_in_folders(self, root_path, extension):
+    @staticmethod
+    def find_file_type_in_folders(root_path, extension):
         """ Execute a recursive search for all files with provided extension in folder structure. Returns all files
         with the extension in the root_path folder and its subfolders
 
@@ -779,7 +929,7 @@ class RCEInterface(PIDOInterface):
 
             if os.path.isdir(full_path):
                 # Go one level deeper. If results are found, extend the files list
-                files += self.find_file_type_in_folders(full_path, extension)
+                files += RCEInterface.find_file_type_in_folders(full_path, extension)
 
         return files
 